@@ -5,11 +5,14 @@ import numpy.random as npr
 import scipy.integrate as spi
 import scipy.optimize as spo
 import copy as cp
+import hashlib
+import concurrent.futures as cf
 import astropy.units as u
 
 from fake_spectra import spectra as sa
 from fake_spectra import griddedspectra as gs
 
+import os
 import sys
 
 from power_spectra import *
@@ -25,46 +28,64 @@ class Box(object):
         self.nskewers = nskewers
         self.scale_factor = 1. / (1. + self._redshift)
         self.convert_fourier_units_to_distance = False
+        self.precision = 'double' #Or 'single' - carried through realisations, coordinate grids and FFTs
+        self.use_units = True #If False, coordinates are plain arrays in configuration_space_units() / fourier_space_units()
+        self.coordinate_grid_cache_dir = None
+        self.clear_coordinate_grid_cache()
 
     def _set_box_units(self,i):
         if self.convert_fourier_units_to_distance == False:
-            return self.voxel_velocities[i]
+            voxel_size = self.voxel_velocities[i]
         else:
-            return self.voxel_lens[i]
+            voxel_size = self.voxel_lens[i]
+        if self.use_units:
+            return voxel_size
+        else: #Unit-free fast path - converted once here to the internal units
+            return voxel_size.to_value(self.configuration_space_units())
+
+    def configuration_space_units(self):
+        """Internal units of the unit-free coordinates - inverted for Fourier space"""
+        if self.convert_fourier_units_to_distance == False:
+            return u.km / u.s
+        else:
+            return u.Mpc
+
+    def fourier_space_units(self):
+        return 1. / self.configuration_space_units()
 
     #1D coordinate arrays
     def k_i(self,i):
         box_units = self._set_box_units(i)
         if i == 'z':
-            return np.fft.fftfreq(self._n_samp[i], d=box_units) * 2. * mh.pi #2 * pi for "cosmologist's k"
+            return (np.fft.fftfreq(self._n_samp[i], d=box_units) * 2. * mh.pi).astype(get_float_dtype(self.precision)) #2 * pi for "cosmologist's k"
         else:
-            return np.fft.fftfreq(self._n_samp[i], d=box_units) * 2. * mh.pi
+            return (np.fft.fftfreq(self._n_samp[i], d=box_units) * 2. * mh.pi).astype(get_float_dtype(self.precision))
 
     def k_z_mod(self):
         box_units = self._set_box_units('z')
-        return np.fft.rfftfreq(self._n_samp['z'], d=box_units) * 2. * mh.pi
+        return (np.fft.rfftfreq(self._n_samp['z'], d=box_units) * 2. * mh.pi).astype(get_float_dtype(self.precision))
 
     #Cylindrical coordinate system
-    def k_z_mod_box(self):
+    def _build_k_z_mod_box(self):
         x = np.zeros_like(self.k_i('x'))[:, np.newaxis, np.newaxis]
         y = np.zeros_like(self.k_i('y'))[np.newaxis, :, np.newaxis]
         z = self.k_i('z')[np.newaxis, np.newaxis, :]
         return x + y + np.absolute(z)
 
-    def k_perp_box(self):
+    def _build_k_perp_box(self):
         x = self.k_i('x')[:, np.newaxis, np.newaxis]
         y = self.k_i('y')[np.newaxis, :, np.newaxis]
         z = np.zeros_like(self.k_i('z'))[np.newaxis, np.newaxis, :]
         return np.sqrt(x**2 + y**2) + z
 
     #Spherical coordinate system
-    def k_box(self):
+    def _build_k_box(self):
         x = self.k_i('x')[:,np.newaxis,np.newaxis]
         y = self.k_i('y')[np.newaxis,:,np.newaxis]
         z = self.k_i('z')[np.newaxis,np.newaxis,:]
         return np.sqrt(x**2 + y**2 + z**2)
 
-    def mu_box(self):
+    def _build_mu_box(self):
         x = self.k_i('x')[:, np.newaxis, np.newaxis]
         y = self.k_i('y')[np.newaxis, :, np.newaxis]
         z = self.k_i('z')[np.newaxis, np.newaxis, :]
@@ -76,15 +97,15 @@ class Box(object):
     #Configuration space coordinates
     def r_i(self,i):
         box_units = self._set_box_units(i)
-        return np.arange(self._n_samp[i]) * box_units
+        return (np.arange(self._n_samp[i]) * box_units).astype(get_float_dtype(self.precision))
 
-    def r_box(self):
+    def _build_r_box(self):
         x = self.r_i('x')[:,np.newaxis,np.newaxis]
         y = self.r_i('y')[np.newaxis,:,np.newaxis]
         z = self.r_i('z')[np.newaxis,np.newaxis,:]
         return np.sqrt(x**2 + y**2 + z**2)
 
-    def mu_r_box(self):
+    def _build_mu_r_box(self):
         x = self.r_i('x')[:, np.newaxis, np.newaxis]
         y = self.r_i('y')[np.newaxis, :, np.newaxis]
         z = self.r_i('z')[np.newaxis, np.newaxis, :]
@@ -92,6 +113,96 @@ class Box(object):
         r[r == 0.] = np.nan
         return z / r
 
+    #Open grid - broadcastable 1D views in place of full 3D boxes
+    def k_open_grid(self, half=False):
+        """(k_x, k_y, k_z) with shapes (n_x, 1, 1), (1, n_y, 1) and (1, 1, n_z) - only k_z >= 0 if half"""
+        k_z = self.k_i('z')
+        if half:
+            k_z = k_z[:self._n_samp['z'] // 2 + 1]
+        return self.k_i('x')[:, np.newaxis, np.newaxis], self.k_i('y')[np.newaxis, :, np.newaxis], k_z[np.newaxis, np.newaxis, :]
+
+    #Radial shells
+    def k_shells(self):
+        """Unique |k| shells and the shell index of every mode, so that isotropic functions of |k| need only be
+        evaluated once per shell. If the fundamental mode is the same along every axis, |k|^2 is an integer multiple of
+        its square and the shells are found by direct integer indexing; otherwise by sorting."""
+        k_fundamental = [get_value(self.k_i(i)[1]) for i in ['x', 'y', 'z']]
+        if np.allclose(k_fundamental, k_fundamental[0]):
+            m_squared = [np.rint(get_value(self.k_i(i)) / k_fundamental[0]).astype(np.int64) ** 2 for i in ['x', 'y', 'z']]
+            q = m_squared[0][:, np.newaxis, np.newaxis] + m_squared[1][np.newaxis, :, np.newaxis] + m_squared[2][np.newaxis, np.newaxis, :]
+            q_present = np.zeros(np.max(m_squared[0]) + np.max(m_squared[1]) + np.max(m_squared[2]) + 1, dtype=bool)
+            q_present[q] = True
+            q_shell_index = (np.cumsum(q_present) - 1).astype(np.int32)
+            k_shell_values = (np.sqrt(np.nonzero(q_present)[0]) * self.k_i('x')[1]).astype(get_float_dtype(self.precision))
+            return k_shell_values, q_shell_index[q]
+        k_shell_values, k_shell_index = unique_with_inverse(self.k_box())
+        return k_shell_values, k_shell_index.astype(np.int32)
+
+    #Cylindrical symmetry
+    def k_cylinders(self):
+        """Line-of-sight and unique perpendicular k values, with indices that broadcast to the full box, so that
+        functions of (k_para, k_perp) need only be evaluated on a 2D table"""
+        k_perp_values, k_perp_index = unique_with_inverse(np.sqrt(self.k_i('x')[:, np.newaxis] ** 2 + self.k_i('y')[np.newaxis, :] ** 2))
+        k_para_index = np.arange(self._n_samp['z'])
+        return self.k_i('z'), k_para_index[np.newaxis, np.newaxis, :], k_perp_values, k_perp_index[:, :, np.newaxis]
+
+    #Cached coordinate grids
+    def _coordinate_grid_key(self):
+        geometry = tuple((self._n_samp[i], repr(self._set_box_units(i))) for i in ['x', 'y', 'z'])
+        return geometry + (self.convert_fourier_units_to_distance, self.precision, self.use_units)
+
+    def clear_coordinate_grid_cache(self):
+        self._coordinate_grid_cache = {}
+        self._coordinate_grid_cache_key = None
+
+    def _get_coordinate_grid(self, grid_name):
+        """Build a coordinate grid lazily and cache it (read-only) until the geometry, the Fourier units or the
+        precision change. If coordinate_grid_cache_dir is set, grids are also persisted and memory-mapped from disk."""
+        grid_key = self._coordinate_grid_key()
+        if grid_key != self._coordinate_grid_cache_key:
+            self.clear_coordinate_grid_cache()
+            self._coordinate_grid_cache_key = grid_key
+        if grid_name not in self._coordinate_grid_cache:
+            if self.coordinate_grid_cache_dir is None:
+                grid = getattr(self, '_build_' + grid_name)()
+            else:
+                grid = self._load_persisted_coordinate_grid(grid_name, grid_key)
+            grid.setflags(write=False)
+            self._coordinate_grid_cache[grid_name] = grid
+        return self._coordinate_grid_cache[grid_name]
+
+    def _load_persisted_coordinate_grid(self, grid_name, grid_key):
+        fname = os.path.join(self.coordinate_grid_cache_dir, '%s_%s.npy' % (grid_name, hashlib.md5(repr(grid_key).encode()).hexdigest()))
+        if not os.path.exists(fname):
+            grid = getattr(self, '_build_' + grid_name)()
+            np.save(fname, get_value(grid))
+            if is_astropy_quantity(grid):
+                with open(fname + '.unit', 'w') as unit_file:
+                    unit_file.write(grid.unit.to_string())
+        if not os.path.exists(fname + '.unit'):
+            return np.load(fname, mmap_mode='r')
+        with open(fname + '.unit') as unit_file:
+            unit = u.Unit(unit_file.read())
+        return u.Quantity(np.load(fname, mmap_mode='r'), unit, copy=False)
+
+    def k_z_mod_box(self):
+        return self._get_coordinate_grid('k_z_mod_box')
+
+    def k_perp_box(self):
+        return self._get_coordinate_grid('k_perp_box')
+
+    def k_box(self):
+        return self._get_coordinate_grid('k_box')
+
+    def mu_box(self):
+        return self._get_coordinate_grid('mu_box')
+
+    def r_box(self):
+        return self._get_coordinate_grid('r_box')
+
+    def mu_r_box(self):
+        return self._get_coordinate_grid('mu_r_box')
+
     def hubble_z(self):
         return self._H0 * np.sqrt(self._omega_m * (1 + self._redshift) ** 3 + 1. - self._omega_m)
 
@@ -115,39 +226,224 @@ class GaussianBox(Box):
         self._voigt_profile_skewers_index_arr = np.zeros(self.nskewers)
         self._voigt_profile_skewers_bool_arr = np.zeros(self.nskewers, dtype=bool)
 
-    def _gauss_realisation(self, power_evaluated, k_box):
-        gauss_k=np.sqrt(0.5*power_evaluated)*(npr.standard_normal(size=power_evaluated.shape)+npr.standard_normal(size=power_evaluated.shape)*1.j)
-        gauss_k[k_box == 0.] = 0. #Zeroing the mean
-        gauss_k_hermitian = make_box_hermitian(gauss_k)
-        return np.fft.ifftn(gauss_k_hermitian, s=(self._n_samp['x'], self._n_samp['y'], self._n_samp['z']), axes=(0, 1, 2))
+        self.use_real_fft = False #Draw only the independent half-spectrum and return a real box
+        self.fixed_amplitude = False #Fix |delta_k|^2 = P(k) and draw only the phases
+        self.paired_realisations = False #Return (realisation, phase-inverted partner) tuples
+        self.use_open_grid = False #Evaluate power slab-by-slab without materialising full k and mu boxes
+        self.use_k_shells = False #Evaluate isotropic power once per unique |k| shell
+        self.inject_voigt_in_fourier_space = False #Add Voigt profiles using their analytic Fourier transform
+        self.use_voigt_templates = False #Shift and interpolate cached Voigt templates rather than calling wofz
+        self.voigt_template_cache_dir = None
+
+    def _gauss_amplitude(self, power_evaluated, k_box):
+        """sqrt(P / 2) amplitude grid and zero-mode mask - restricted to the k_z >= 0 half if use_real_fft.
+        If k_box is None (open grid), the zero mode is indexed directly."""
+        if is_astropy_quantity(power_evaluated):
+            power_evaluated = power_evaluated.value
+        if self.use_real_fft:
+            n_z_half = self._n_samp['z'] // 2 + 1
+            power_evaluated = power_evaluated[..., :n_z_half]
+            if k_box is not None:
+                k_box = k_box[..., :n_z_half]
+        if k_box is None:
+            zero_mode_bool_arr = (0, 0, 0)
+        else:
+            zero_mode_bool_arr = (k_box == 0.)
+        return np.sqrt(0.5 * power_evaluated).astype(get_float_dtype(self.precision), copy=False), zero_mode_bool_arr
+
+    def _gauss_realisation_from_amplitude(self, gauss_amplitude, zero_mode_bool_arr, rng=None):
+        if rng is None:
+            rng = npr
+        float_dtype = get_float_dtype(self.precision)
+        if self.fixed_amplitude: #Random phases only - amplitudes are fixed after the Hermitian constraints
+            gauss_k = np.exp(2. * mh.pi * 1.j * rng.uniform(size=gauss_amplitude.shape).astype(float_dtype, copy=False))
+        else:
+            gauss_k = gauss_amplitude * (rng.standard_normal(size=gauss_amplitude.shape).astype(float_dtype, copy=False) + rng.standard_normal(size=gauss_amplitude.shape).astype(float_dtype, copy=False) * 1.j)
+        gauss_k[zero_mode_bool_arr] = 0. #Zeroing the mean
+        fft = get_fft_module(self.precision)
+        if self.use_real_fft: #Only the k_z >= 0 half of the Fourier box is drawn
+            gauss_k = make_half_box_hermitian(gauss_k, self._n_samp['z'])
+            if self.fixed_amplitude:
+                gauss_k = fix_mode_amplitudes(gauss_k, gauss_amplitude, zero_mode_bool_arr)
+            realisation = fft.irfftn(gauss_k, s=(self._n_samp['x'], self._n_samp['y'], self._n_samp['z']), axes=(0, 1, 2))
+        else:
+            gauss_k_hermitian = make_box_hermitian(gauss_k)
+            if self.fixed_amplitude:
+                gauss_k_hermitian = fix_mode_amplitudes(gauss_k_hermitian, gauss_amplitude, zero_mode_bool_arr)
+            realisation = fft.ifftn(gauss_k_hermitian, s=(self._n_samp['x'], self._n_samp['y'], self._n_samp['z']), axes=(0, 1, 2))
+        if self.paired_realisations: #Phase-inverted partner: every mode shifted by pi
+            return realisation, -1. * realisation
+        return realisation
+
+    def _gauss_realisation(self, power_evaluated, k_box, rng=None):
+        gauss_amplitude, zero_mode_bool_arr = self._gauss_amplitude(power_evaluated, k_box)
+        return self._gauss_realisation_from_amplitude(gauss_amplitude, zero_mode_bool_arr, rng=rng)
+
+    def _ensemble_worker_box(self):
+        """Shallow copy without the cached coordinate grids, so that only the geometry and flags are sent to workers"""
+        worker_box = cp.copy(self)
+        worker_box.clear_coordinate_grid_cache()
+        return worker_box
+
+    def gauss_realisation_ensemble(self, power_spectrum_instance, n_realisations, seed=None, n_processes=1, anisotropic=False, callback=None, savefile_root=None):
+        """Generate n_realisations Gaussian realisations over a process pool. Each realisation has its own seed stream
+        spawned from seed, so the ensemble is reproducible irrespective of n_processes. The sqrt(P / 2) amplitude grid is
+        evaluated once and shared by all realisations. Each realisation is passed to callback(i, realisation) and/or
+        saved to savefile_root_i.npy as it finishes; if neither is given, the list of realisations is returned."""
+        power_evaluated, k_box = self._evaluate_power_for_realisation(power_spectrum_instance, anisotropic)
+        gauss_amplitude, zero_mode_bool_arr = self._gauss_amplitude(power_evaluated, k_box)
+        del k_box, power_evaluated #k_box itself stays in the coordinate grid cache - it is not sent to the workers
+        seed_sequences = npr.SeedSequence(seed).spawn(n_realisations)
+
+        realisations = [None] * n_realisations
+        def _stream_realisation(i, realisation):
+            if callback is not None:
+                callback(i, realisation)
+            if savefile_root is not None:
+                np.save('%s_%i.npy' % (savefile_root, i), realisation)
+            if (callback is None) and (savefile_root is None):
+                realisations[i] = realisation
+
+        if n_processes == 1:
+            for i in range(n_realisations):
+                _stream_realisation(i, self._gauss_realisation_from_amplitude(gauss_amplitude, zero_mode_bool_arr, rng=npr.default_rng(seed_sequences[i])))
+        else:
+            with cf.ProcessPoolExecutor(max_workers=n_processes, initializer=_set_ensemble_worker_state, initargs=(self._ensemble_worker_box(), gauss_amplitude, zero_mode_bool_arr)) as executor:
+                futures = {executor.submit(_ensemble_worker_realisation, seed_sequences[i]): i for i in range(n_realisations)}
+                for future in cf.as_completed(futures):
+                    _stream_realisation(futures[future], future.result())
+
+        if (callback is None) and (savefile_root is None):
+            return realisations
+
+    def _k_mu_half_slab(self, x_start, x_stop):
+        """|k| and mu for the x-slab [x_start, x_stop) of the k_z >= 0 half of the Fourier box"""
+        x = self.k_i('x')[x_start:x_stop, np.newaxis, np.newaxis]
+        y = self.k_i('y')[np.newaxis, :, np.newaxis]
+        z = self.k_i('z')[np.newaxis, np.newaxis, :self._n_samp['z'] // 2 + 1]
+        k = np.sqrt(x**2 + y**2 + z**2)
+        mu = z / k
+        mu[k == 0.] = np.nan
+        return k, mu
+
+    def _n_planes_in_slab(self, bytes_per_plane, memory_budget):
+        return int(max(1, min(memory_budget // bytes_per_plane, self._n_samp['x'])))
+
+    def out_of_core_gauss_realisation(self, power_spectrum_instance, fname, memory_budget=1.e+9, x_step=1, anisotropic=False, keep_modes=False, rng=None):
+        """Generate a (real) Gaussian realisation slab-by-slab in memory-mapped .npy files so that peak memory
+        is bounded by memory_budget (bytes). Only every x_step-th x-plane is transformed and written to fname.
+        Modes are drawn x-plane by x-plane, so the realisation does not depend on memory_budget. If paired_realisations,
+        the phase-inverted partner is also written (to fname with a _partner suffix) and a tuple is returned."""
+        if rng is None:
+            rng = npr
+        n_x, n_y, n_z = self._n_samp['x'], self._n_samp['y'], self._n_samp['z']
+        n_z_half = n_z // 2 + 1
+        x_samples = np.arange(0, n_x, x_step)
+        fname_root = fname[:-4] if fname.endswith('.npy') else fname
+        modes_fname = fname_root + '_modes.npy'
+        float_dtype = get_float_dtype(self.precision)
+        fft = get_fft_module(self.precision)
+        modes = np.lib.format.open_memmap(modes_fname, mode='w+', dtype=get_complex_dtype(self.precision), shape=(n_x, n_y, n_z_half))
+
+        #Draw the modes of the half-spectrum in x-slabs
+        n_planes = self._n_planes_in_slab(n_y * n_z_half * 80, memory_budget)
+        for x_start in range(0, n_x, n_planes):
+            k, mu = self._k_mu_half_slab(x_start, x_start + n_planes)
+            if anisotropic:
+                power_evaluated = power_spectrum_instance.evaluate3d_anisotropic(k, mu)
+            else:
+                power_evaluated = power_spectrum_instance.evaluate3d_isotropic(k)
+            if is_astropy_quantity(power_evaluated):
+                power_evaluated = power_evaluated.value
+            gauss_k = np.empty(k.shape, dtype=modes.dtype)
+            for i in range(k.shape[0]):
+                if self.fixed_amplitude: #Random phases only
+                    gauss_k[i] = np.exp(2. * mh.pi * 1.j * rng.uniform(size=k.shape[1:]).astype(float_dtype, copy=False))
+                else:
+                    gauss_k[i] = rng.standard_normal(size=k.shape[1:]).astype(float_dtype, copy=False) + rng.standard_normal(size=k.shape[1:]).astype(float_dtype, copy=False) * 1.j
+            if self.fixed_amplitude:
+                gauss_k *= np.sqrt(power_evaluated).astype(float_dtype, copy=False)
+            else:
+                gauss_k *= np.sqrt(0.5 * power_evaluated).astype(float_dtype, copy=False)
+            gauss_k[k == 0.] = 0. #Zeroing the mean
+            modes[x_start: x_start + n_planes] = gauss_k
+        hermitian_planes = [0, n_z_half - 1] if n_z % 2 == 0 else [0] #With the Nyquist plane
+        for z in hermitian_planes:
+            plane = modes[:, :, z]
+            plane_hermitian = make_plane_hermitian(plane)
+            if self.fixed_amplitude: #Amplitudes are fixed after the Hermitian constraints
+                plane_hermitian = fix_mode_amplitudes(plane_hermitian, np.absolute(plane) / mh.sqrt(2.), (plane == 0.))
+            modes[:, :, z] = plane_hermitian
+
+        #Inverse FFT along x in y-slabs
+        n_planes_y = int(max(1, min(memory_budget // (n_x * n_z_half * 32), n_y)))
+        for y_start in range(0, n_y, n_planes_y):
+            modes[:, y_start: y_start + n_planes_y] = fft.ifft(modes[:, y_start: y_start + n_planes_y], axis=0)
+        modes.flush()
+
+        #Inverse FFT along y then z for the requested x-planes only
+        realisation = np.lib.format.open_memmap(fname, mode='w+', dtype=float_dtype, shape=(x_samples.size, n_y, n_z))
+        if self.paired_realisations:
+            realisation_partner = np.lib.format.open_memmap(fname_root + '_partner.npy', mode='w+', dtype=float_dtype, shape=realisation.shape)
+        n_planes = self._n_planes_in_slab(n_y * ((n_z_half * 32) + (n_z * 8)), memory_budget)
+        for i in range(0, x_samples.size, n_planes):
+            modes_slab = fft.ifft(modes[x_samples[i: i + n_planes]], axis=1)
+            realisation[i: i + n_planes] = fft.irfft(modes_slab, n=n_z, axis=2)
+            if self.paired_realisations: #Phase-inverted partner: every mode shifted by pi
+                realisation_partner[i: i + n_planes] = -1. * realisation[i: i + n_planes]
+        realisation.flush()
+
+        del modes
+        if not keep_modes:
+            os.remove(modes_fname)
+        if self.paired_realisations:
+            realisation_partner.flush()
+            return realisation, realisation_partner
+        return realisation
+
+    def _evaluate_power_for_realisation(self, box_spectra, anisotropic):
+        """Power (and the k box for the zero mode) - evaluated slab-by-slab on the open grid if use_open_grid"""
+        if self.use_open_grid:
+            return box_spectra.evaluate3d_open_grid(self.k_open_grid(half=self.use_real_fft), anisotropic=anisotropic), None
+        k_box = self.k_box()
+        if self.use_k_shells:
+            k_shells = self.k_shells()
+        else:
+            k_shells = None
+        if anisotropic:
+            return box_spectra.evaluate3d_anisotropic(k_box, self.mu_box(), k_shells=k_shells, k_cylinders=self.k_cylinders()), k_box
+        elif k_shells is not None:
+            return box_spectra.evaluate3d_isotropic_shells(*k_shells), k_box
+        else:
+            return box_spectra.evaluate3d_isotropic(k_box), k_box
 
     def isotropic_power_law_gauss_realisation(self,pow_index,pow_pivot,pow_amp):
         box_spectra = PowerLawPowerSpectrum(pow_index, pow_pivot, pow_amp)
-        power_evaluated = box_spectra.evaluate3d_isotropic(self.k_box())
-        return self._gauss_realisation(power_evaluated,self.k_box())
+        power_evaluated, k_box = self._evaluate_power_for_realisation(box_spectra, False)
+        return self._gauss_realisation(power_evaluated,k_box)
 
     def anisotropic_power_law_gauss_realisation(self, pow_index, pow_pivot, pow_amp, mu_coefficients):
         box_spectra = PowerLawPowerSpectrum(pow_index, pow_pivot, pow_amp)
         box_spectra.set_anisotropic_functional_form(mu_coefficients)
-        power_evaluated = box_spectra.evaluate3d_anisotropic(self.k_box(),self.mu_box())
-        return self._gauss_realisation(power_evaluated,self.k_box())
+        power_evaluated, k_box = self._evaluate_power_for_realisation(box_spectra, True)
+        return self._gauss_realisation(power_evaluated,k_box)
 
     def isotropic_pre_computed_gauss_realisation(self,fname,n_interpolation_samples='default'):
         box_spectra = PreComputedPowerSpectrum(fname,n_interpolation_samples=n_interpolation_samples)
         orig_fourier_units_bool = self.convert_fourier_units_to_distance
         self.convert_fourier_units_to_distance = True
-        power_evaluated = box_spectra.evaluate3d_isotropic(self.k_box())
+        power_evaluated, k_box = self._evaluate_power_for_realisation(box_spectra, False)
         self.convert_fourier_units_to_distance = orig_fourier_units_bool
-        return self._gauss_realisation(power_evaluated,self.k_box())
+        return self._gauss_realisation(power_evaluated,k_box)
 
     def anisotropic_pre_computed_gauss_realisation(self, fname, mu_coefficients, n_interpolation_samples='default'):
         box_spectra = PreComputedPowerSpectrum(fname,n_interpolation_samples=n_interpolation_samples)
         box_spectra.set_anisotropic_functional_form(mu_coefficients)
         orig_fourier_units_bool = self.convert_fourier_units_to_distance
         self.convert_fourier_units_to_distance = True
-        power_evaluated = box_spectra.evaluate3d_anisotropic(self.k_box(),self.mu_box())
+        power_evaluated, k_box = self._evaluate_power_for_realisation(box_spectra, True)
         self.convert_fourier_units_to_distance = orig_fourier_units_bool
-        return self._gauss_realisation(power_evaluated,self.k_box())
+        return self._gauss_realisation(power_evaluated,k_box)
 
     def isotropic_CAMB_gauss_realisation(self):
         return 0
@@ -160,32 +456,105 @@ class GaussianBox(Box):
         self._voigt_profile_skewers_bool_arr[self._voigt_profile_skewers_index_arr] = True
         self.num_clean_skewers = self.nskewers - np.sum(self._voigt_profile_skewers_bool_arr)
 
-    def _evaluate_voigt_profiles(self,z_values,z0_values,sigma,gamma,amp,wrap_around):
-        voigt_profile_box = np.zeros((self.nskewers, self._n_samp['z']))
-        voigt_profiles_unwrapped = voigt_amplified(z_values[np.newaxis, :], sigma, gamma, amp, z0_values[:, np.newaxis])
+    def _scatter_profiles_onto_skewers(self, profiles_wrapped, profile_index, weights=None, chunk_size=10000):
+        """Add profiles_wrapped[profile_index] (times any weights) to the skewers chosen for the absorbers. Each chunk is
+        summed only over the skewers it touches, so temporaries scale with the chunk rather than the box"""
+        profile_box = np.zeros((self.nskewers, self._n_samp['z']))
+        z_index = np.arange(self._n_samp['z'])
+        for chunk_start in range(0, self._num_voigt, chunk_size):
+            chunk = slice(chunk_start, chunk_start + chunk_size)
+            chunk_skewers, chunk_skewers_index = np.unique(self._voigt_profile_skewers_index_arr[chunk], return_inverse=True)
+            chunk_index = chunk_skewers_index.reshape(-1)[:, np.newaxis] * self._n_samp['z'] + z_index[np.newaxis, :]
+            chunk_profiles = profiles_wrapped[profile_index[chunk]]
+            if weights is not None:
+                chunk_profiles = chunk_profiles * weights[chunk][:, np.newaxis]
+            profile_box[chunk_skewers] += np.bincount(chunk_index.ravel(), weights=chunk_profiles.ravel(),
+                                                      minlength=chunk_skewers.size * self._n_samp['z']).reshape(chunk_skewers.size, -1)
+        return profile_box
+
+    def _evaluate_voigt_profiles(self,z_values,z0_values,sigma,gamma,amp,wrap_around,return_unwrapped=False,chunk_size=10000):
+        """Profiles are evaluated once per distinct central position, folded over the wrap-around periods and then
+        scatter-added to the skewers in chunks of absorbers"""
+        z0_unique, z0_inverse = unique_with_inverse(z0_values)
+        if self.use_voigt_templates:
+            voigt_profiles_unwrapped = voigt_amplified_from_template(z_values[np.newaxis, :], sigma, gamma, amp, z0_unique[:, np.newaxis], self.voxel_velocities['z'], cache_dir=self.voigt_template_cache_dir)
+        else:
+            voigt_profiles_unwrapped = get_value(voigt_amplified(z_values[np.newaxis, :], sigma, gamma, amp, z0_unique[:, np.newaxis]))
         voigt_profiles_wrapped = np.sum(voigt_profiles_unwrapped.reshape(voigt_profiles_unwrapped.shape[0], 1 + (2 * wrap_around),-1), axis=-2)
-        j = 0
-        for i in self._voigt_profile_skewers_index_arr:
-            if is_astropy_quantity(voigt_profiles_wrapped[j]):
-                additional_profile = voigt_profiles_wrapped[j].value
-            else:
-                additional_profile = voigt_profiles_wrapped[j]
-            voigt_profile_box[i] += additional_profile
-            j+=1
-        return voigt_profile_box, voigt_profiles_unwrapped
 
-    def _form_voigt_profile_box(self, sigma, gamma, amp, wrap_around):
-        z_values = np.arange(start = (-1*wrap_around)*self._n_samp['z'], stop = (1+wrap_around)*self._n_samp['z']) * self.voxel_velocities['z']
-        print(z_values)
+        voigt_profile_box = self._scatter_profiles_onto_skewers(voigt_profiles_wrapped, z0_inverse, chunk_size=chunk_size)
+        if return_unwrapped:
+            return voigt_profile_box, voigt_profiles_unwrapped[z0_inverse]
+        else:
+            return voigt_profile_box, None
+
+    def _evaluate_voigt_profiles_fourier(self,z0_values,sigma,gamma,amp):
+        """Profiles are convolved onto the skewers along z using the analytic Voigt Fourier transform, so the sum over
+        all wrap-around periods is implicit (up to aliasing of modes beyond the Nyquist frequency)"""
+        z0_index = np.rint(u.Quantity(z0_values / self.voxel_velocities['z'], u.dimensionless_unscaled).value).astype(int) % self._n_samp['z']
+        absorber_counts = np.bincount(self._voigt_profile_skewers_index_arr * self._n_samp['z'] + z0_index, minlength=self.nskewers * self._n_samp['z'])
+
+        sigma_voxels = u.Quantity(sigma / self.voxel_velocities['z'], u.dimensionless_unscaled).value
+        gamma_voxels = u.Quantity(gamma / self.voxel_velocities['z'], u.dimensionless_unscaled).value
+        k_voxels = np.fft.rfftfreq(self._n_samp['z']) * 2. * mh.pi
+        profile_FT = amp * voigt_fourier_transform(k_voxels, sigma_voxels, gamma_voxels, 0.) / voigt(0., sigma_voxels, gamma_voxels, 0.)
+        absorber_counts_FT = np.fft.rfft(absorber_counts.reshape(self.nskewers, self._n_samp['z']), axis=-1)
+        return np.fft.irfft(absorber_counts_FT * profile_FT[np.newaxis, :], n=self._n_samp['z'], axis=-1), None
+
+    def _form_voigt_profile_box(self, sigma, gamma, amp, wrap_around, return_unwrapped=False):
         z0_values = npr.choice(self._n_samp['z'], self._num_voigt, replace=True) * self.voxel_velocities['z']  # km / s
-        return self._evaluate_voigt_profiles(z_values,z0_values,sigma,gamma,amp,wrap_around)
+        if self.inject_voigt_in_fourier_space:
+            return self._evaluate_voigt_profiles_fourier(z0_values,sigma,gamma,amp)
+        z_values = np.arange(start = (-1*wrap_around)*self._n_samp['z'], stop = (1+wrap_around)*self._n_samp['z']) * self.voxel_velocities['z']
+        return self._evaluate_voigt_profiles(z_values,z0_values,sigma,gamma,amp,wrap_around,return_unwrapped=return_unwrapped)
 
-    def add_voigt_profiles(self,gauss_box,num_voigt,sigma,gamma,amp,wrap_around=0): #Use velocity units
+    def add_voigt_profiles(self,gauss_box,num_voigt,sigma,gamma,amp,wrap_around=0,return_unwrapped=False): #Use velocity units
         self._num_voigt = num_voigt
         self._choose_location_voigt_profiles_in_sky()
-        voigt_profile_box,voigt_unwrapped = self._form_voigt_profile_box(sigma, gamma, amp, wrap_around)
+        voigt_profile_box,voigt_unwrapped = self._form_voigt_profile_box(sigma, gamma, amp, wrap_around, return_unwrapped=return_unwrapped)
         return gauss_box - (voigt_profile_box.reshape(gauss_box.shape) * (1. + 0.j)), voigt_unwrapped
 
+    def _form_HCD_optical_depth_box(self, column_densities, wrap_around, chunk_size=10000, rng=None):
+        """Optical depths are linear in column density, so the profile per unit column density is evaluated once per
+        distinct central position and scaled by each absorber's column density as it is scattered onto the skewers"""
+        if rng is None:
+            rng = npr
+        z_values = np.arange(start = (-1*wrap_around)*self._n_samp['z'], stop = (1+wrap_around)*self._n_samp['z']) * self.voxel_velocities['z']
+        z0_unique, z0_inverse = unique_with_inverse(rng.choice(self._n_samp['z'], self._num_voigt, replace=True) * self.voxel_velocities['z'])
+        optical_depth_unit_column = full_voigt_optical_depth(z_values[np.newaxis, :], 1. / (u.cm ** 2), z0_unique[:, np.newaxis])[0].value
+        optical_depth_wrapped = np.sum(optical_depth_unit_column.reshape(z0_unique.shape[0], 1 + (2 * wrap_around), -1), axis=-2)
+        return self._scatter_profiles_onto_skewers(optical_depth_wrapped, z0_inverse, weights=get_value(column_densities), chunk_size=chunk_size)
+
+    def add_HCD_optical_depths(self, delta_flux_box, mean_flux, num_HCD, cddf, column_density_bin_edges, wrap_around=0, chunk_size=10000, rng=None, log10_edges=False):
+        """Inject num_HCD absorbers with column densities [cm^-2] drawn from a column density distribution (histogram
+        counts and bin edges - log10 edges if log10_edges, e.g. from utils.load_CDDF) into a box of flux fluctuations about mean_flux by F = mean_flux (1 + delta) -> F exp(-tau).
+        Returns the contaminated flux fluctuations (about the contaminated mean flux), the contaminated mean flux and the
+        column densities drawn"""
+        if rng is None:
+            rng = npr
+        self._num_voigt = num_HCD
+        self._voigt_profile_skewers_index_arr = rng.choice(self.nskewers, num_HCD, replace=True)
+        self._voigt_profile_skewers_bool_arr[self._voigt_profile_skewers_index_arr] = True
+        self.num_clean_skewers = self.nskewers - np.sum(self._voigt_profile_skewers_bool_arr)
+        column_densities = sample_column_densities(num_HCD, cddf, column_density_bin_edges, rng=rng, log10_edges=log10_edges)
+        optical_depth_box = self._form_HCD_optical_depth_box(column_densities, wrap_around, chunk_size=chunk_size, rng=rng)
+        flux_box = mean_flux * (1. + delta_flux_box) * np.exp(-1. * optical_depth_box.reshape(delta_flux_box.shape))
+        contaminated_mean_flux = np.mean(flux_box, dtype=np.float64)
+        return flux_box / contaminated_mean_flux - 1., contaminated_mean_flux, column_densities
+
+
+#Process pool workers for GaussianBox.gauss_realisation_ensemble
+_ensemble_worker_state = {}
+
+def _set_ensemble_worker_state(box_instance, gauss_amplitude, zero_mode_bool_arr):
+    _ensemble_worker_state['box_instance'] = box_instance
+    _ensemble_worker_state['gauss_amplitude'] = gauss_amplitude
+    _ensemble_worker_state['zero_mode_bool_arr'] = zero_mode_bool_arr
+
+def _ensemble_worker_realisation(seed_sequence):
+    return _ensemble_worker_state['box_instance']._gauss_realisation_from_amplitude(_ensemble_worker_state['gauss_amplitude'],
+                    _ensemble_worker_state['zero_mode_bool_arr'], rng=npr.default_rng(seed_sequence))
+
 
 class SimulationBox(Box):
     """Sub-class to generate a box of Lyman-alpha spectra drawn from HDF5 simulations"""
@@ -266,6 +635,32 @@ class SimulationBox(Box):
             self.spectra_instance.save_file()  # Save spectra to file
         return tau
 
+    def _streamed_mean_flux(self, tau_dataset_name, chunk_size, tau_scaling):
+        flux_sum, n_pixels = 0., 0
+        for tau in hdf5_dataset_chunks(self.spectra_instance.savefile, tau_dataset_name, chunk_size):
+            flux_sum += np.sum(np.exp(-1. * tau * tau_scaling), dtype=np.float64)
+            n_pixels += tau.size
+        return flux_sum / n_pixels
+
+    def delta_flux_skewer_chunks(self, chunk_size=1000, mean_flux_desired=None, mean_flux_specified=None, tau_scaling_specified=None):
+        """Yield delta flux skewers chunk_size at a time straight from the spectra savefile (see save_file), so the full
+        optical depth array is never held in memory. Options as skewers_realisation - but each pass over the file is one
+        mean flux evaluation, so mean_flux_desired (solving for the tau scaling) takes ~10 extra passes and an
+        unspecified mean flux one extra pass"""
+        tau_dataset_name = 'tau/%s/%i/%i' % (self.element, self.ion, int(self.line_wavelength.value))
+        if tau_scaling_specified is not None:
+            tau_scaling = tau_scaling_specified
+        elif mean_flux_desired is not None:
+            minim = lambda scale: mean_flux_desired - self._streamed_mean_flux(tau_dataset_name, chunk_size, scale)
+            tau_scaling = spo.brentq(minim, 0, 20., rtol=1e-6)
+        else:
+            tau_scaling = 1.
+        if mean_flux_specified is None:
+            mean_flux_specified = self._streamed_mean_flux(tau_dataset_name, chunk_size, tau_scaling)
+        for tau in hdf5_dataset_chunks(self.spectra_instance.savefile, tau_dataset_name, chunk_size):
+            tau = tau.astype(get_float_dtype(self.precision), copy=False)
+            yield np.exp(-1. * tau * float(tau_scaling)) / float(mean_flux_specified) - 1.
+
     def get_column_density(self, element = None, ion = None, save_file=False):
         if element is None:
             element = self.element
@@ -295,9 +690,10 @@ class SimulationBox(Box):
     def get_mean_flux(self, optical_depth=None, tau_scaling_factor=1.):
         if optical_depth is None:
             optical_depth = self.get_optical_depth()
-        return np.mean(np.exp(-1. * optical_depth * tau_scaling_factor))
+        return np.mean(np.exp(-1. * optical_depth * tau_scaling_factor), dtype=np.float64)
 
     def _get_delta_flux(self, tau, mean_flux_desired, mean_flux_specified, tau_scaling_specified):
+        tau = tau.astype(get_float_dtype(self.precision), copy=False)
         if mean_flux_desired is None:
             tau_scaling = 1.
         else:
@@ -312,7 +708,7 @@ class SimulationBox(Box):
             mean_flux = mean_flux_specified
 
         print('Mean flux = %f' %mean_flux)
-        return np.exp(-1. * tau * tau_scaling) / mean_flux - 1.
+        return np.exp(-1. * tau * float(tau_scaling)) / float(mean_flux) - 1.
 
     def _get_delta_density(self, density):
         mean_density = np.mean(density)
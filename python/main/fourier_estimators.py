@@ -1,10 +1,10 @@
+import collections
+import concurrent.futures as cf
 import math as mh
-import random as rd
 import numpy as np
 import numpy.random as npr
 import scipy.integrate as spi
 import scipy.special as sps
-import copy as cp
 import astropy.units as u
 
 from fake_spectra import spectra as sa
@@ -15,13 +15,20 @@ import sys
 
 from utils import *
 
-def get_matter_power_spectrum_two_coords_binned(redshift, k_box, coord_box1, coord_box2, n_bins1, n_bins2,
-                                                hubble_constant, cosmology_name='base_plikHM_TTTEEE_lowTEB_2015'):
+def get_matter_power_spectrum_two_coords_binned(redshift, k_box, hubble_constant, coord_box1=None, coord_box2=None, n_bins1=None, n_bins2=None,
+                                                cosmology_name='base_plikHM_TTTEEE_lowTEB_2015', binning_plan=None):
+    """Bin CAMB matter power on (coord_box1, coord_box2) with n_bins1, n_bins2 (numbers of bins or edges) - or with a
+    BinningPlan, in which case the coordinate boxes and bins are not needed"""
+    assert (binning_plan is not None) or ((coord_box1 is not None) and (coord_box2 is not None))
     from CAMB_bDM_tests import main as camb_wrap
 
+    if (binning_plan is not None) and binning_plan.real_fft:
+        k_box = k_box[..., :(binning_plan.shape[-1] // 2) + 1]
     k_h = k_box.flatten()[1:] / hubble_constant
     camb_cosmology_instance = camb_wrap.CAMB_bDM_cosmology(cosmology_name=cosmology_name, k_h_range=[np.min(k_h), np.max(k_h)], z=np.linspace(start=redshift, stop=0., num=4))
     matter_power_spectrum_unbinned = camb_cosmology_instance.get_P_k_z(k_h=k_h)[0][-1]
+    if binning_plan is not None:
+        return binning_plan.bin(np.concatenate(([0.], matter_power_spectrum_unbinned))) #Zero mode is in the overflow bin
 
     x = coord_box1.flatten()[1:]
     y = coord_box2.flatten()[1:]
@@ -29,24 +36,145 @@ def get_matter_power_spectrum_two_coords_binned(redshift, k_box, coord_box1, coo
     return bin_f_x_y_histogram(x, y, matter_power_spectrum_unbinned, n_bins1, n_bins2)
 
 
+class BinningPlan(object):
+    """Class to hold the (|k|, |mu|) bin of every Fourier mode of a box, so that it is assigned only once"""
+    def __init__(self, box_instance, k_bins, mu_bins, real_fft = False):
+        k_box = box_instance.k_box()
+        abs_mu_box = np.absolute(box_instance.mu_box())
+        self.real_fft = real_fft #Plan for FourierEstimator3D.use_real_fft
+        self.shape = k_box.shape
+        if real_fft:
+            k_box = k_box[..., :(self.shape[-1] // 2) + 1]
+            abs_mu_box = abs_mu_box[..., :(self.shape[-1] // 2) + 1]
+        if is_astropy_quantity(k_bins):
+            if is_astropy_quantity(k_box):
+                self.k_unit = k_bins.unit
+                k_box = k_box.to_value(self.k_unit)
+            else: #Unit-free box - the bins are converted to its Fourier units
+                self.k_unit = u.Unit(box_instance.fourier_space_units())
+            k_bins = k_bins.to_value(self.k_unit)
+        else:
+            self.k_unit = None
+            k_box = get_value(k_box)
+        k = k_box.flatten()[1:] #Drop the zero mode
+        mu = get_value(abs_mu_box).flatten()[1:]
+        self.k_bin_edges = get_bin_edges(k_bins, np.min(k), np.max(k))
+        self.mu_bin_edges = get_bin_edges(mu_bins, np.min(mu), np.max(mu))
+        self.bins_shape = (self.k_bin_edges.size - 1, self.mu_bin_edges.size - 1)
+
+        n_bins = self.bins_shape[0] * self.bins_shape[1]
+        bin_index = digitise_x_y(k, mu, self.k_bin_edges, self.mu_bin_edges)
+        bin_index[bin_index < 0] = n_bins #Overflow bin for modes outside the bins
+        self.bin_index = np.concatenate(([n_bins], bin_index)).astype(np.int32 if n_bins < np.iinfo(np.int32).max else np.int64)
+        if real_fft:
+            self.mode_weights = np.broadcast_to(half_spectrum_mode_weights(self.shape[-1]), k_box.shape).flatten()
+        else:
+            self.mode_weights = None
+        self.counts = self._bin_sum(None)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.k_mean = self._bin_sum(k_box) / self.counts
+            self.mu_mean = self._bin_sum(get_value(abs_mu_box)) / self.counts
+
+    def _bin_sum(self, values, k_bins_only = False):
+        if values is not None:
+            values = np.ravel(get_value(values))
+        if self.mode_weights is not None:
+            values = self.mode_weights if values is None else values * self.mode_weights
+        if k_bins_only:
+            bin_index, bins_shape = self.bin_index // self.bins_shape[1], self.bins_shape[:1] #Overflow bin maps to n_k
+        else:
+            bin_index, bins_shape = self.bin_index, self.bins_shape
+        n_bins = int(np.prod(bins_shape))
+        return np.bincount(bin_index, weights=values, minlength=n_bins + 1)[:n_bins].astype(np.float64).reshape(bins_shape)
+
+    def k_bins_counts(self):
+        return np.sum(self.counts, axis=-1)
+
+    def bin_k(self, f_box):
+        """Mean of a box of Fourier-space values in each k bin (over all the mu bins)"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._bin_sum(f_box, k_bins_only = True) / self.k_bins_counts()
+
+    def bin(self, f_box):
+        """Mean of a box of Fourier-space values (e.g. estimated or theory power) in each bin"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._bin_sum(f_box) / self.counts
+
+    def bin_standard_error(self, f_box, f_mean = None):
+        if f_mean is None:
+            f_mean = self.bin(f_box)
+        f_mean_per_mode = np.concatenate((f_mean.flatten(), [0.]))[self.bin_index]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            f_variance = self._bin_sum((np.ravel(get_value(f_box)) - f_mean_per_mode) ** 2) / (self.counts - 1.)
+            return np.sqrt(f_variance / self.counts)
+
+    def save(self, fname):
+        np.savez(fname, bin_index = self.bin_index, mode_weights = np.array([]) if self.mode_weights is None else self.mode_weights,
+                 k_bin_edges = self.k_bin_edges, mu_bin_edges = self.mu_bin_edges, counts = self.counts, k_mean = self.k_mean,
+                 mu_mean = self.mu_mean, shape = self.shape, real_fft = self.real_fft, k_unit = '' if self.k_unit is None else self.k_unit.to_string())
+
+
+def load_binning_plan(fname):
+    """Load a BinningPlan saved by BinningPlan.save"""
+    binning_plan = BinningPlan.__new__(BinningPlan)
+    with np.load(fname) as plan_file:
+        binning_plan.bin_index = plan_file['bin_index']
+        binning_plan.mode_weights = plan_file['mode_weights'] if plan_file['mode_weights'].size > 0 else None
+        for attribute in ['k_bin_edges', 'mu_bin_edges', 'counts', 'k_mean', 'mu_mean']:
+            setattr(binning_plan, attribute, plan_file[attribute])
+        binning_plan.shape = tuple(plan_file['shape'])
+        binning_plan.real_fft = bool(plan_file['real_fft'])
+        binning_plan.k_unit = u.Unit(str(plan_file['k_unit'])) if str(plan_file['k_unit']) else None
+    binning_plan.bins_shape = binning_plan.counts.shape
+    return binning_plan
+
+def get_power_1D_streamed(skewer_chunks, norm = True, covariance = False, precision = 'double'):
+    """1D power from an iterable of skewer chunks (e.g. utils.hdf5_dataset_chunks or SimulationBox.delta_flux_skewer_chunks)
+    accumulated one chunk at a time, so memory does not scale with the number of skewers. Returns the mean power, the
+    variance of the power between skewers, the number of skewers and (if covariance) the covariance between k modes"""
+    fft = get_fft_module(precision)
+    running_statistics = None
+    for skewers in skewer_chunks:
+        real_space_modes = cast_to_precision(np.asarray(skewers), precision)
+        real_space_modes = real_space_modes.reshape((-1, real_space_modes.shape[-1]))
+        if norm == False:
+            norm_fac = 1.
+        elif norm == True:
+            norm_fac = 1. / real_space_modes.shape[-1]
+        fourier_modes = fft.rfft(real_space_modes, axis = -1) * norm_fac
+        power = np.real(fourier_modes) ** 2 + np.imag(fourier_modes) ** 2
+        running_statistics = update_running_statistics(running_statistics, power, covariance = covariance)
+    if running_statistics is None:
+        raise ValueError('No skewers in skewer_chunks')
+    n_skewers, average_power, power_m2 = running_statistics
+    if n_skewers < 2:
+        raise ValueError('The variance of the power between skewers needs at least 2 skewers - got %i' % n_skewers)
+    power_covariance = power_m2 / (n_skewers - 1)
+    if covariance:
+        return average_power, np.diag(power_covariance).copy(), n_skewers, power_covariance
+    return average_power, power_covariance, n_skewers
+
+
 class FourierEstimator(object):
     """Class to estimate power spectra from a box of fluctuations"""
-    def __init__(self, first_box, second_box):
+    def __init__(self, first_box, second_box, precision='double'):
         self._first_box = first_box
         self._second_box = second_box
+        self._precision = precision #'single' binned power agrees with 'double' to a relative tolerance of ~1.e-5
+        self._fft = get_fft_module(precision)
 
 
 class FourierEstimator1D(FourierEstimator):
     """Sub-class to calculate 1D power spectra"""
-    def __init__(self, first_box, second_box = None, n_skewers = None):
-        super(FourierEstimator1D, self).__init__(first_box, second_box)
+    def __init__(self, first_box, second_box = None, n_skewers = None, precision = 'double'):
+        super(FourierEstimator1D, self).__init__(first_box, second_box, precision)
         if n_skewers == None:
             self._n_skewers = self._first_box.shape[0] * self._first_box.shape[1]
         else:
             self._n_skewers = n_skewers
 
     def samples_1D(self):
-        return rd.sample(np.arange(self._first_box.shape[0] * self._first_box.shape[1]), self._n_skewers)
+        return npr.choice(self._first_box.shape[0] * self._first_box.shape[1], self._n_skewers, replace = False)
 
     def skewers_1D(self):
         if self._first_box.ndim == 3:
@@ -55,75 +183,194 @@ class FourierEstimator1D(FourierEstimator):
             return self._first_box
 
     def get_power_1D(self, norm = True):
-        real_space_modes = self.skewers_1D()
+        real_space_modes = cast_to_precision(self.skewers_1D(), self._precision)
         if norm == False:
             norm_fac = 1.
         elif norm == True:
             norm_fac = 1. / real_space_modes.shape[-1]
-        fourier_modes = np.fft.rfft(real_space_modes, axis = 1) * norm_fac
+        fourier_modes = self._fft.rfft(real_space_modes, axis = 1) * norm_fac
         power = np.real(fourier_modes) ** 2 + np.imag(fourier_modes) ** 2
-        average_power = np.mean(power, axis=0)
+        average_power = np.mean(power, axis=0, dtype=np.float64)
         return average_power
 
+    def get_power_1D_statistics(self, norm = True, covariance = False, chunk_size = 10000):
+        """As get_power_1D but also with the scatter between skewers - see get_power_1D_streamed"""
+        skewers = self.skewers_1D()
+        skewer_chunks = (skewers[i: i + chunk_size] for i in range(0, skewers.shape[0], chunk_size))
+        return get_power_1D_streamed(skewer_chunks, norm = norm, covariance = covariance, precision = self._precision)
+
 
 class FourierEstimator3D(FourierEstimator):
     """Sub-class to calculate 3D power spectra"""
-    def __init__(self, first_box, second_box = None, grid = True, x_step = 1, y_step = 1, n_skewers = 0):
-        super(FourierEstimator3D, self).__init__(first_box, second_box)
+    def __init__(self, first_box, second_box = None, grid = True, x_step = 1, y_step = 1, n_skewers = 0, precision = 'double'):
+        super(FourierEstimator3D, self).__init__(first_box, second_box, precision)
         self._grid = grid
         self._x_step = x_step
         self._y_step = y_step
         self._n_skewers = n_skewers
+        self._skewer_mask = None
+        self._sampling_window = None
+        self.use_real_fft = False #Estimate from the rfftn half-spectrum, weighting modes by their conjugate multiplicity
+
+    def _half_spectrum_mode_weights(self):
+        return half_spectrum_mode_weights(self._first_box.shape[-1])
+
+    def _to_half_spectrum(self, coord_box):
+        """Restrict a full-spectrum coordinate box to the rfftn half-spectrum - coordinates must be even under k -> -k
+        (e.g. |k|, |mu|, k_perp, |k_z|)"""
+        if self.use_real_fft and (coord_box.shape[-1] == self._first_box.shape[-1]):
+            return coord_box[..., :(self._first_box.shape[-1] // 2) + 1]
+        return coord_box
+
+    def _to_full_spectrum(self, half_power):
+        """Rebuild full-spectrum power from the rfftn half-spectrum using P(-k) = P(k)"""
+        n_conjugate = self._first_box.shape[-1] - half_power.shape[-1]
+        conjugate_power = np.flip(half_power[..., 1: n_conjugate + 1], axis=(0, 1, 2))
+        return np.concatenate((half_power, np.roll(conjugate_power, 1, axis=(0, 1))), axis=-1)
+
+    def skewer_mask(self):
+        """Boolean (x, y) mask of the skewers kept when grid == False - drawn once, so every box shares the same skewers"""
+        if self._skewer_mask is None:
+            n_xy = self._first_box.shape[0] * self._first_box.shape[1]
+            skewer_mask = np.zeros(n_xy, dtype=bool)
+            skewer_mask[npr.choice(n_xy, self._n_skewers, replace = False)] = True
+            self._skewer_mask = skewer_mask.reshape(self._first_box.shape[:2])
+        return self._skewer_mask
 
     def samples_3D(self):
         if self._grid == True:
             return np.arange(0, self._first_box.shape[0], self._x_step), np.arange(0, self._first_box.shape[1], self._y_step)
         elif self._grid == False:
-            n_zeros = (self._first_box.shape[0] * self._first_box.shape[1]) - self._n_skewers
-            return rd.sample(np.arange(self._first_box.shape[0] * self._first_box.shape[1]), n_zeros)
+            return np.flatnonzero(np.logical_not(self.skewer_mask())) #Skewers set to zero
 
-    def skewers_3D(self):
+    def skewers_3D(self, box = None):
+        if box is None:
+            box = self._first_box
         if self._grid == True:
-            xy_samps = self.samples_3D()
-            return self._first_box[xy_samps[0], :, :][:, xy_samps[1], :]
+            return box[::self._x_step, ::self._y_step, :] #Strided view - no copy
         elif self._grid == False:
-            skewers = cp.deepcopy(self._first_box)
-            skewers = skewers.reshape((self._first_box.shape[0] * self._first_box.shape[1], -1))
-            skewers[self.samples_3D(), :] = 0. + 0.j
-            skewers = skewers.reshape(self._first_box.shape[0], self._first_box.shape[1], -1)
-            return skewers
+            return np.where(self.skewer_mask()[:, :, np.newaxis], box, 0.)
 
-    def get_power_3D(self, norm = True):
-        real_space_modes = self.skewers_3D()
+    def sampling_mask(self):
+        """Boolean (x, y) mask of the sampled skewers on the full grid - a comb of x_step, y_step if grid == True"""
+        if self._grid == False:
+            return self.skewer_mask()
+        sampling_mask = np.zeros(self._first_box.shape[:2], dtype=bool)
+        sampling_mask[::self._x_step, ::self._y_step] = True
+        return sampling_mask
+
+    def sampling_window(self):
+        """|FFT of the sampling mask / N_xy|^2 - the window in (k_x, k_y) that measured power is convolved with (the mask is
+        constant along z, so there is no k_z extent). Computed once per sampling pattern with its inverse FFT"""
+        if self._sampling_window is None:
+            sampling_mask = self.sampling_mask()
+            mask_modes = np.fft.fft2(sampling_mask) / sampling_mask.size
+            window = np.real(mask_modes) ** 2 + np.imag(mask_modes) ** 2
+            self._sampling_window = window, np.fft.ifft2(window)
+        return self._sampling_window[0]
+
+    def convolve_with_sampling_window(self, power_box):
+        """Expected power of this estimator (norm = True) given theory power on the full (x, y, z) Fourier grid - circular
+        convolution over (k_x, k_y) by FFT, a * b = N_xy fft(ifft(a) ifft(b)), then restricted to the strided sub-grid.
+        If grid == True, x_step and y_step must divide the grid (otherwise the sub-grid modes are not a subset of the
+        full-grid modes) - a ValueError is raised if not"""
+        if (self._grid == True) and ((self._first_box.shape[0] % self._x_step != 0) or (self._first_box.shape[1] % self._y_step != 0)):
+            raise ValueError('Sampling window needs (x_step, y_step) = (%i, %i) to divide the (x, y) grid of (%i, %i) skewers'
+                             % (self._x_step, self._y_step, self._first_box.shape[0], self._first_box.shape[1]))
+        self.sampling_window()
+        window_real_space = self._sampling_window[1]
+        power_real_space = np.fft.ifft2(get_value(power_box), axes=(0, 1))
+        windowed_power = np.real(np.fft.fft2(power_real_space * window_real_space[:, :, np.newaxis], axes=(0, 1)))
+        windowed_power *= window_real_space.size
+        if self._grid == True:
+            n_x, n_y = self._first_box.shape[0] // self._x_step, self._first_box.shape[1] // self._y_step
+            windowed_power = windowed_power[:n_x, :n_y] * ((self._x_step * self._y_step) ** 2) #Normalised by the sub-grid size
+        return self._to_half_spectrum(windowed_power)
+
+    def get_windowed_theory_power_3D(self, power_spectrum, box_instance, anisotropic = False):
+        """Theory power spectrum (a PowerSpectrum instance) evaluated on the modes of box_instance and convolved with the
+        sampling window"""
+        if anisotropic:
+            power_evaluated = power_spectrum.evaluate3d_anisotropic(box_instance.k_box(), box_instance.mu_box())
+        else:
+            power_evaluated = power_spectrum.evaluate3d_isotropic(box_instance.k_box())
+        power_evaluated = np.array(get_value(power_evaluated), dtype=float)
+        power_evaluated[0, 0, 0] = 0. #Zero mean - as in the Gaussian realisations
+        return self.convolve_with_sampling_window(power_evaluated)
+
+    def _get_fourier_modes(self, box, norm):
+        if self._grid == False:
+            real_space_modes = box
+        else:
+            real_space_modes = cast_to_precision(self.skewers_3D(box), self._precision)
         if norm == False:
             norm_fac = 1.
         elif norm == True:
             norm_fac = 1. / real_space_modes.size
-        fourier_modes = np.fft.fftn(real_space_modes) * norm_fac
+        if self._grid == False:
+            return self._get_masked_fourier_modes(box) * norm_fac
+        if self.use_real_fft:
+            return self._fft.rfftn(np.real(real_space_modes)) * norm_fac
+        else:
+            return self._fft.fftn(real_space_modes) * norm_fac
+
+    def _get_masked_fourier_modes(self, box):
+        """Transform the kept skewers along z, scatter them into the (x, y) grid and transform across skewers -
+        the masked skewers are zero along z, so this equals the fftn of the masked box without copying it"""
+        skewer_mask = self.skewer_mask()
+        kept_skewers = cast_to_precision(box[skewer_mask], self._precision)
+        if self.use_real_fft:
+            kept_modes = self._fft.rfft(np.real(kept_skewers), axis=-1)
+        else:
+            kept_modes = self._fft.fft(kept_skewers, axis=-1)
+        fourier_modes = np.zeros(skewer_mask.shape + kept_modes.shape[-1:], dtype=kept_modes.dtype)
+        fourier_modes[skewer_mask] = kept_modes
+        return self._fft.fftn(fourier_modes, axes=(0, 1))
+
+    def get_power_3D(self, norm = True):
+        fourier_modes = self._get_fourier_modes(self._first_box, norm)
         if self._second_box is None:
             power = np.real(fourier_modes) ** 2 + np.imag(fourier_modes) ** 2
         else:
-            fourier_modes_2 = np.fft.fftn(self._second_box) * norm_fac
+            fourier_modes_2 = self._get_fourier_modes(self._second_box, norm) #With the same skewers as the first box
             power = (fourier_modes.real * fourier_modes_2.real) + (fourier_modes.imag * fourier_modes_2.imag)
         return power, fourier_modes
 
+    def get_power_3D_full_spectrum(self, norm = True):
+        power = self.get_power_3D(norm)[0]
+        if self.use_real_fft:
+            return self._to_full_spectrum(power)
+        return power
+
     def get_power_3D_cylindrical_coords(self, k_z_mod_box, k_perp_box, n_bins_z, n_bins_perp, norm = True):
         power_sorted,k_z_sorted,k_perp_sorted = self.get_power_legendre_integrand(k_z_mod_box, k_perp_box, n_bins_z, norm)
         return bin_2D_data(power_sorted,n_bins_perp),bin_2D_data(k_z_sorted,n_bins_perp),bin_2D_data(k_perp_sorted,n_bins_perp)
 
-    def get_power_3D_unique(self, k_box, norm = True):
+    def get_power_3D_unique(self, k_box, norm = True, count = False, std_err = False, k_shells = None):
+        """Average power in shells of unique |k| - by np.unique of k_box or from the (k_shell_values, k_shell_index) of
+        Box.k_shells - with optional mode counts and standard errors"""
         power = self.get_power_3D(norm)[0]
-        k_unique = np.unique(k_box)
-        power_unique = np.zeros_like(k_unique.value)
-        for i in range(k_unique.shape[0]):
-            print("Binning 3D power according to unique value of |k| #%i/%i" %(i+1, k_unique.shape[0]))
-            power_unique[i] = np.mean(power[k_box == k_unique[i]])
-        return power_unique, k_unique
+        if k_shells is None:
+            k_unique, k_index = unique_with_inverse(self._to_half_spectrum(k_box))
+        else:
+            k_unique, k_index = k_shells[0], self._to_half_spectrum(k_shells[1])
+        if self.use_real_fft:
+            mode_weights = np.broadcast_to(self._half_spectrum_mode_weights(), power.shape)
+        else:
+            mode_weights = None
+        power_unique, counts, power_std_err = bin_f_index_statistics(k_index, power, k_unique.shape[0], weights=mode_weights)
+
+        return_list = [power_unique, k_unique]
+        if count == True:
+            return_list.append(counts)
+        if std_err == True:
+            return_list.append(power_std_err)
+        return tuple(return_list)
 
     def get_flux_power_3D_sorted(self, k_box, norm = True, mu_box = None):
         k_argsort = np.argsort(k_box, axis = None)
-        power = self.get_power_3D(norm)[0]
-        if mu_box == None:
+        power = self.get_power_3D_full_spectrum(norm)
+        if mu_box is None:
             return sort_3D_to_1D(power, k_argsort)[1:], sort_3D_to_1D(k_box, k_argsort)[1:]
         else:
             return sort_3D_to_1D(power, k_argsort)[1:],sort_3D_to_1D(k_box, k_argsort)[1:],sort_3D_to_1D(mu_box, k_argsort)[1:]
@@ -133,29 +380,186 @@ class FourierEstimator3D(FourierEstimator):
         return bin_1D_data(power_sorted, n_bins), bin_1D_data(k_sorted, n_bins)
 
     def _form_return_list(self, x, y, n_bins_x, n_bins_y, norm, bin_coord_x, bin_coord_y, count, std_err):
-        ensemble_statistic = self.get_power_3D(norm)[0].flatten()[1:]
+        power = self.get_power_3D(norm)[0]
+        if self.use_real_fft:
+            mode_weights = np.broadcast_to(self._half_spectrum_mode_weights(), power.shape).flatten()[1:]
+        else:
+            mode_weights = None
+        power_mean, counts, power_std_err, x_mean, y_mean = bin_f_x_y_histogram_statistics(x, y, power.flatten()[1:], n_bins_x, n_bins_y, weights=mode_weights)
 
-        return_list = [None] * (1 + bin_coord_x + bin_coord_y + count + std_err) #Number of calculations
-        return_list[0] = bin_f_x_y_histogram(x, y, ensemble_statistic, n_bins_x, n_bins_y) #Always bin power
-        i = 1
+        return_list = [power_mean] #Always bin power
         if bin_coord_x == True:
-            return_list[i] = bin_f_x_y_histogram(x, y, x, n_bins_x, n_bins_y)
-            i+=1
+            return_list.append(x_mean)
         if bin_coord_y == True:
-            return_list[i] = bin_f_x_y_histogram(x, y, y, n_bins_x, n_bins_y)
-            i+=1
+            return_list.append(y_mean)
         if count == True:
-            return_list[i] = bin_f_x_y_histogram_count(x, y, ensemble_statistic, n_bins_x, n_bins_y)
-            i+=1
+            return_list.append(counts)
         if std_err == True:
-            return_list[i] = bin_f_x_y_histogram_standard_error(x, y, ensemble_statistic, n_bins_x, n_bins_y)
+            return_list.append(power_std_err)
         return return_list
 
     def get_power_3D_two_coords_binned(self, coord_box1, coord_box2, n_bins1, n_bins2, norm=True, bin_coord1=True, bin_coord2=True, count=False, std_err=False):
-        x = coord_box1.flatten()[1:]
-        y = coord_box2.flatten()[1:]
+        x = self._to_half_spectrum(coord_box1).flatten()[1:]
+        y = self._to_half_spectrum(coord_box2).flatten()[1:]
         return self._form_return_list(x, y, n_bins1, n_bins2, norm, bin_coord1, bin_coord2, count, std_err)
 
+    def get_power_3D_plan_binned(self, binning_plan, norm=True, bin_coord1=True, bin_coord2=True, count=False, std_err=False):
+        """As get_power_3D_two_coords_binned(k_box, |mu_box|, ...) but with the bin assignment of a BinningPlan, so that
+        only the FFT and a bincount are needed"""
+        assert binning_plan.real_fft == self.use_real_fft
+        power = self.get_power_3D(norm)[0]
+        power_mean = binning_plan.bin(power)
+        return_list = [power_mean]
+        if bin_coord1 == True:
+            return_list.append(binning_plan.k_mean)
+        if bin_coord2 == True:
+            return_list.append(binning_plan.mu_mean)
+        if count == True:
+            return_list.append(binning_plan.counts)
+        if std_err == True:
+            return_list.append(binning_plan.bin_standard_error(power, power_mean))
+        return return_list
+
+    def get_power_3D_multipoles_plan_binned(self, binning_plan, mu_box, multipoles = (0, 2, 4), norm = True, bin_coord = True, count = False, std_err = False):
+        """Legendre multipoles (2 ell + 1) <P(k, mu) L_ell(mu)> in the k bins of a BinningPlan, with one bincount per
+        multipole - optionally with the mean k, mode counts and Gaussian errors (2 ell + 1) sqrt(<P^2 L_ell^2> / N)"""
+        assert binning_plan.real_fft == self.use_real_fft
+        power = get_value(self.get_power_3D(norm)[0])
+        mu = get_value(self._to_half_spectrum(mu_box))
+        k_bins_counts = binning_plan.k_bins_counts()
+        power_multipoles = np.zeros((len(multipoles), k_bins_counts.size))
+        power_multipoles_std_err = np.zeros_like(power_multipoles)
+        for i, multipole in enumerate(multipoles):
+            power_legendre_weighted = power * evaluate_legendre_polynomial(mu, multipole) * ((2. * multipole) + 1.)
+            power_multipoles[i] = binning_plan.bin_k(power_legendre_weighted)
+            if std_err == True:
+                power_multipoles_std_err[i] = np.sqrt(binning_plan.bin_k(power_legendre_weighted ** 2) / k_bins_counts)
+
+        return_list = [power_multipoles]
+        if bin_coord == True:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return_list.append(np.nansum(binning_plan.k_mean * binning_plan.counts, axis=-1) / k_bins_counts)
+        if count == True:
+            return_list.append(k_bins_counts)
+        if std_err == True:
+            return_list.append(power_multipoles_std_err)
+        return return_list
+
+    def _sub_volumes(self, n_sub_volumes):
+        """Yield the (x, y) blocks of the sampled skewers - strided views of the boxes (and of the skewer mask if grid == False)"""
+        if self._grid == True:
+            first_box, second_box = self.skewers_3D(), None if self._second_box is None else self.skewers_3D(self._second_box)
+        else:
+            first_box, second_box = self._first_box, self._second_box
+        if (first_box.shape[0] % n_sub_volumes[0] != 0) or (first_box.shape[1] % n_sub_volumes[1] != 0):
+            raise ValueError('n_sub_volumes = (%i, %i) must divide the (x, y) grid of (%i, %i) sampled skewers'
+                             % (n_sub_volumes[0], n_sub_volumes[1], first_box.shape[0], first_box.shape[1]))
+        n_x, n_y = first_box.shape[0] // n_sub_volumes[0], first_box.shape[1] // n_sub_volumes[1]
+        for i in range(n_sub_volumes[0]):
+            for j in range(n_sub_volumes[1]):
+                block = (slice(i * n_x, (i + 1) * n_x), slice(j * n_y, (j + 1) * n_y))
+                yield (first_box[block], None if second_box is None else second_box[block],
+                       None if self._grid == True else self.skewer_mask()[block])
+
+    def get_power_3D_sub_volume_covariance(self, binning_plan, n_sub_volumes = (2, 2), resampling = 'jackknife', n_bootstrap = 1000,
+                                           norm = True, n_processes = 1, seed = None):
+        """Mean (k, mu)-binned power of n_sub_volumes[0] x n_sub_volumes[1] sub-volumes of the skewer grid and the jackknife or
+        bootstrap covariance of that mean between the (flattened) bins. binning_plan must be made for the sub-volume box
+        and n_sub_volumes must divide the sampled skewer grid (otherwise a ValueError is raised).
+        Sub-volumes are transformed over a process pool and their binned power streamed to the reducer as each finishes,
+        so only about one sub-volume is held per worker. The delete-one jackknife of the mean reduces to the sample
+        covariance of the sub-volumes / n, which is accumulated online"""
+        assert resampling in ('jackknife', 'bootstrap')
+        assert binning_plan.real_fft == self.use_real_fft
+        n_total = n_sub_volumes[0] * n_sub_volumes[1]
+        power_sub_volumes = np.zeros((n_total, int(np.prod(binning_plan.bins_shape))))
+        running_statistics = [None]
+        def _reduce_sub_volume(i, power_binned):
+            running_statistics[0] = update_running_statistics(running_statistics[0], power_binned.reshape(1, -1), covariance = True)
+            if resampling == 'bootstrap':
+                power_sub_volumes[i] = power_binned.flatten()
+
+        worker_state = (binning_plan, norm, self.use_real_fft, self._precision)
+        if n_processes == 1:
+            _set_sub_volume_worker_state(*worker_state)
+            for i, sub_volume in enumerate(self._sub_volumes(n_sub_volumes)):
+                _reduce_sub_volume(i, _sub_volume_worker_power(*sub_volume))
+        else:
+            with cf.ProcessPoolExecutor(max_workers=n_processes, initializer=_set_sub_volume_worker_state, initargs=worker_state) as executor:
+                futures = {executor.submit(_sub_volume_worker_power, *sub_volume): i for i, sub_volume in enumerate(self._sub_volumes(n_sub_volumes))}
+                for future in cf.as_completed(futures):
+                    _reduce_sub_volume(futures[future], future.result())
+
+        n_total, power_mean, power_m2 = running_statistics[0]
+        if resampling == 'jackknife':
+            power_covariance = power_m2 / (n_total * (n_total - 1))
+        elif resampling == 'bootstrap':
+            resamples = npr.default_rng(seed).integers(n_total, size=(n_bootstrap, n_total))
+            power_covariance = np.cov(np.mean(power_sub_volumes[resamples], axis=1), rowvar=False)
+        return power_mean.reshape(binning_plan.bins_shape), power_covariance
+
+    def _open_grid_coords_slab(self, k_open_grid, i, k_unit):
+        k, mu = open_grid_k_mu_slab(k_open_grid, i, i + 1)
+        if (k_unit is not None) and is_astropy_quantity(k):
+            k = k.to(k_unit)
+        k = get_value(k)
+        non_zero_bool_arr = (k != 0.) #Drop the zero mode
+        return k[non_zero_bool_arr], np.absolute(mu[non_zero_bool_arr]), non_zero_bool_arr
+
+    def _open_grid_bin_edges(self, k_open_grid, k_bins, mu_bins, k_unit):
+        if np.ndim(k_bins) > 0 and np.ndim(mu_bins) > 0:
+            return np.array(k_bins), np.array(mu_bins)
+        coord_min = [np.inf, np.inf]
+        coord_max = [-np.inf, -np.inf]
+        for i in range(k_open_grid[0].shape[0]):
+            k, mu = self._open_grid_coords_slab(k_open_grid, i, k_unit)[:2]
+            for j, coord in enumerate([k, mu]):
+                if coord.size > 0:
+                    coord_min[j] = min(coord_min[j], np.min(coord))
+                    coord_max[j] = max(coord_max[j], np.max(coord))
+        return [get_bin_edges(bins, coord_min[j], coord_max[j]) for j, bins in enumerate([k_bins, mu_bins])]
+
+    def get_power_3D_two_coords_binned_open_grid(self, k_open_grid, k_bins, mu_bins, norm=True, bin_coord1=True, bin_coord2=True, count=False, std_err=False):
+        """As get_power_3D_two_coords_binned(k_box, |mu_box|, ...) but with |k| and |mu| computed one x-plane at a time
+        from an open grid of broadcastable (k_x, k_y, k_z) axes, so that full coordinate boxes are never materialised"""
+        power = self.get_power_3D(norm)[0]
+        k_open_grid = tuple(self._to_half_spectrum(k_i) for k_i in k_open_grid)
+        if is_astropy_quantity(k_bins):
+            k_unit = k_bins.unit
+            k_bins = k_bins.value
+        else:
+            k_unit = None
+        k_bin_edges, mu_bin_edges = self._open_grid_bin_edges(k_open_grid, k_bins, mu_bins, k_unit)
+
+        n_bins = (k_bin_edges.size - 1) * (mu_bin_edges.size - 1)
+        bin_sums = np.zeros((5, n_bins)) #Count, power, power^2, k, mu
+        for i in range(power.shape[0]):
+            k, mu, non_zero_bool_arr = self._open_grid_coords_slab(k_open_grid, i, k_unit)
+            power_slab = power[i: i + 1][non_zero_bool_arr].astype(np.float64)
+            if self.use_real_fft:
+                mode_weights = np.broadcast_to(self._half_spectrum_mode_weights(), power[i: i + 1].shape)[non_zero_bool_arr]
+            else:
+                mode_weights = np.ones_like(power_slab)
+            bin_index = digitise_x_y(k, mu, k_bin_edges, mu_bin_edges)
+            in_bins = bin_index >= 0
+            for j, values in enumerate([1., power_slab, power_slab ** 2, k, mu]):
+                bin_sums[j] += np.bincount(bin_index[in_bins], weights=(values * mode_weights)[in_bins], minlength=n_bins)
+        bin_sums = bin_sums.reshape(5, k_bin_edges.size - 1, mu_bin_edges.size - 1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            power_mean = bin_sums[1] / bin_sums[0]
+            return_list = [power_mean]
+            if bin_coord1 == True:
+                return_list.append(bin_sums[3] / bin_sums[0])
+            if bin_coord2 == True:
+                return_list.append(bin_sums[4] / bin_sums[0])
+            if count == True:
+                return_list.append(bin_sums[0])
+            if std_err == True:
+                power_variance = (bin_sums[2] - (bin_sums[0] * (power_mean ** 2))) / (bin_sums[0] - 1.)
+                return_list.append(np.sqrt(power_variance / bin_sums[0]))
+        return return_list
+
     def get_power_legendre_integrand(self, k_box, mu_box, n_bins, norm = True): #NEEDS TIDYING-UP!!!
         power_sorted, k_sorted, mu_sorted = self.get_flux_power_3D_sorted(k_box, norm, mu_box)
         mu_2D_k_sorted = arrange_data_in_2D(mu_sorted, n_bins)
@@ -175,4 +579,78 @@ class FourierEstimator3D(FourierEstimator):
         power_mu_sorted, k_mu_sorted, mu_mu_sorted = self.get_power_legendre_integrand(k_box, mu_box, n_bins, norm)
         total_integrand = power_mu_sorted * evaluate_legendre_polynomial(mu_mu_sorted, multipole)
         power_integrated = np.trapz(total_integrand, x = mu_mu_sorted) * ((2. * multipole + 1.) / 2.)
-        return power_integrated, np.mean(k_mu_sorted, axis = -1), power_mu_sorted
\ No newline at end of file
+        return power_integrated, np.mean(k_mu_sorted, axis = -1), power_mu_sorted
+
+
+_sub_volume_worker_state = {}
+
+def _set_sub_volume_worker_state(binning_plan, norm, use_real_fft, precision):
+    _sub_volume_worker_state['binning_plan'] = binning_plan
+    _sub_volume_worker_state['norm'] = norm
+    _sub_volume_worker_state['use_real_fft'] = use_real_fft
+    _sub_volume_worker_state['precision'] = precision
+
+def _sub_volume_worker_power(first_sub_volume, second_sub_volume, skewer_mask):
+    if skewer_mask is not None: #Copies only this sub-volume
+        first_sub_volume = np.where(skewer_mask[:, :, np.newaxis], first_sub_volume, 0.)
+        if second_sub_volume is not None:
+            second_sub_volume = np.where(skewer_mask[:, :, np.newaxis], second_sub_volume, 0.)
+    sub_volume_estimator = FourierEstimator3D(first_sub_volume, second_box = second_sub_volume, precision = _sub_volume_worker_state['precision'])
+    sub_volume_estimator.use_real_fft = _sub_volume_worker_state['use_real_fft']
+    return sub_volume_estimator.get_power_3D_plan_binned(_sub_volume_worker_state['binning_plan'], norm = _sub_volume_worker_state['norm'],
+                                                         bin_coord1 = False, bin_coord2 = False)[0]
+
+
+class FourierEstimatorMultiField(FourierEstimator3D):
+    """Sub-class to calculate all auto and cross 3D power spectra of several named fields, transforming each once"""
+    def __init__(self, fields, grid = True, x_step = 1, y_step = 1, n_skewers = 0, precision = 'double', max_cached_fields = 'default'):
+        self._fields = collections.OrderedDict(fields)
+        super(FourierEstimatorMultiField, self).__init__(list(self._fields.values())[0], None, grid, x_step, y_step, n_skewers, precision)
+        if max_cached_fields == 'default':
+            max_cached_fields = len(self._fields)
+        self._max_cached_fields = max_cached_fields #Fewer bounds memory at the cost of re-transforming evicted fields
+        self._fourier_modes_cache = collections.OrderedDict()
+
+    def field_names(self):
+        return list(self._fields.keys())
+
+    def clear_fourier_modes_cache(self):
+        self._fourier_modes_cache.clear()
+
+    def get_fourier_modes(self, field_name, norm = True):
+        cache_key = (field_name, norm)
+        if cache_key in self._fourier_modes_cache:
+            self._fourier_modes_cache.move_to_end(cache_key)
+            return self._fourier_modes_cache[cache_key]
+        fourier_modes = self._get_fourier_modes(self._fields[field_name], norm)
+        self._fourier_modes_cache[cache_key] = fourier_modes
+        while len(self._fourier_modes_cache) > self._max_cached_fields:
+            self._fourier_modes_cache.popitem(last=False)
+        return fourier_modes
+
+    def get_cross_power_3D(self, field_name_1, field_name_2, norm = True):
+        fourier_modes_2 = self.get_fourier_modes(field_name_2, norm)
+        fourier_modes_1 = self.get_fourier_modes(field_name_1, norm)
+        return (fourier_modes_1.real * fourier_modes_2.real) + (fourier_modes_1.imag * fourier_modes_2.imag)
+
+    def get_all_power_3D_plan_binned(self, binning_plan, norm = True, std_err = False):
+        """Binned power of every auto and cross combination of the fields, keyed by pairs of field names, and of every
+        spectrum divided by each auto-spectrum, keyed by (pair, field name). Optionally also the standard errors"""
+        assert binning_plan.real_fft == self.use_real_fft
+        field_names = self.field_names()
+        power_binned = collections.OrderedDict()
+        power_std_err = collections.OrderedDict()
+        for i, field_name_1 in enumerate(field_names):
+            for field_name_2 in field_names[i:]:
+                power = self.get_cross_power_3D(field_name_1, field_name_2, norm)
+                power_binned[(field_name_1, field_name_2)] = binning_plan.bin(power)
+                if std_err == True:
+                    power_std_err[(field_name_1, field_name_2)] = binning_plan.bin_standard_error(power, power_binned[(field_name_1, field_name_2)])
+        power_ratios = collections.OrderedDict()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for field_pair in power_binned:
+                for field_name in field_names:
+                    power_ratios[(field_pair, field_name)] = power_binned[field_pair] / power_binned[(field_name, field_name)]
+        if std_err == True:
+            return power_binned, power_ratios, power_std_err
+        return power_binned, power_ratios
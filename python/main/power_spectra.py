@@ -27,15 +27,58 @@ class PowerSpectrum():
         k_perp_max = np.sqrt(np.max(k_x_vec) ** 2 + np.max(k_y_vec) ** 2)
         pow_kz = np.zeros(k_z_vec.shape[0])
         for i in range(k_z_vec.shape[0]):
-            pow_kz[i] = spi.quad(self._integrand, k_perp_min.value, k_perp_max.value, (k_z_vec[i].value,))[0]
+            pow_kz[i] = spi.quad(self._integrand, get_value(k_perp_min), get_value(k_perp_max), (get_value(k_z_vec[i]),))[0]
         return pow_kz
 
+    def _set_evaluation_range(self, k_min, k_max):
+        pass
+
+    def evaluate3d_open_grid(self, k_open_grid, anisotropic=False):
+        """Evaluate on an open grid of broadcastable (k_x, k_y, k_z) axes one x-plane at a time, so that full k
+        and mu boxes are never materialised"""
+        self._set_evaluation_range(*open_grid_k_range(k_open_grid))
+        power_evaluated = np.zeros(open_grid_shape(k_open_grid))
+        for i in range(power_evaluated.shape[0]):
+            k, mu = open_grid_k_mu_slab(k_open_grid, i, i + 1)
+            if anisotropic:
+                power_slab = self.evaluate3d_anisotropic(k, mu)
+            else:
+                power_slab = self.evaluate3d_isotropic(k)
+            if is_astropy_quantity(power_slab):
+                power_slab = power_slab.value
+            power_evaluated[i: i + 1] = power_slab
+        self._set_evaluation_range(None, None)
+        return power_evaluated
+
     def set_anisotropic_functional_form(self,mu_coefficients):
         self._mu_coefficients = mu_coefficients
 
-    def evaluate3d_anisotropic(self,k,mu):
-        k_para, k_perp = spherical_to_cylindrical_coordinates(k, mu)
-        return self.evaluate3d_isotropic(k) * np.polyval(self._mu_coefficients(k_para,k_perp),mu)
+    def evaluate3d_isotropic_shells(self, k_shell_values, k_shell_index):
+        """Evaluate once per unique |k| shell (see Box.k_shells) and scatter back to every mode"""
+        return get_value(self.evaluate3d_isotropic(k_shell_values))[k_shell_index]
+
+    def _evaluate_mu_polynomial(self, k, mu, k_cylinders=None):
+        """With k_cylinders (see Box.k_cylinders), evaluate the mu coefficients on the 2D table of the grid's unique
+        (k_para, k_perp) and sum the polynomial in mu by Horner's rule, indexing back into the table rather than forming
+        full-size coefficient boxes. Off a grid (e.g. evaluate_multipole), the coefficients are evaluated mode by mode"""
+        if k_cylinders is None:
+            k_para, k_perp = spherical_to_cylindrical_coordinates(k, mu)
+            return np.polyval(self._mu_coefficients(k_para, k_perp), mu)
+        k_para_values, k_para_index, k_perp_values, k_perp_index = k_cylinders
+        table_shape = (np.size(k_perp_values), np.size(k_para_values))
+        k_para_table = k_para_values[np.newaxis, :] * np.ones(table_shape)
+        k_perp_table = k_perp_values[:, np.newaxis] * np.ones(table_shape)
+        mu_polynomial = 0.
+        for coefficient in self._mu_coefficients(k_para_table, k_perp_table):
+            mu_polynomial = mu_polynomial * mu + np.broadcast_to(coefficient, table_shape)[k_perp_index, k_para_index]
+        return mu_polynomial
+
+    def evaluate3d_anisotropic(self,k,mu,k_shells=None,k_cylinders=None):
+        if k_shells is None:
+            power_isotropic = self.evaluate3d_isotropic(k)
+        else:
+            power_isotropic = self.evaluate3d_isotropic_shells(*k_shells)
+        return power_isotropic * self._evaluate_mu_polynomial(k, mu, k_cylinders=k_cylinders)
 
     def evaluate_multipole(self,multipole,k):
         mu_samples = np.linspace(-1.,1.,2000) * u.dimensionless_unscaled
@@ -53,11 +96,9 @@ class PowerLawPowerSpectrum(PowerSpectrum):
         self._pow_amp = pow_amp
 
     def evaluate3d_isotropic(self, k):
-        Pk = self._pow_amp * ((k / self._pow_pivot) ** self._pow_index)
-        if is_astropy_quantity(k):
-            return Pk
-        else:
-            return Pk.value
+        if not is_astropy_quantity(k): #Unit-free fast path - k in the units of the pivot
+            return self._pow_amp * ((k / self._pow_pivot.value) ** self._pow_index)
+        return self._pow_amp * ((k / self._pow_pivot) ** self._pow_index)
 
 
 class PreComputedPowerSpectrum(PowerSpectrum):
@@ -71,6 +112,7 @@ class PreComputedPowerSpectrum(PowerSpectrum):
 
         self.k_raw, self.power_raw = np.loadtxt(self._fname,unpack=True)
         self.k_raw = self.k_raw / u.Mpc #Convert to Astropy quantity
+        self._evaluation_range = None
 
     def _form_reduced_arrays(self, k_raw_reduced, power_raw_reduced):
         slice_array = gen_log_space(k_raw_reduced.size,self._n_interpolation_samples)
@@ -79,18 +121,34 @@ class PreComputedPowerSpectrum(PowerSpectrum):
         return k_raw_reduced, power_raw_reduced
 
     def _correction_for_interpolation(self,k_array):
-        assert is_astropy_quantity(k_array)
-        return np.log10(k_array.value) + 100.
+        """log10(k / (1 / Mpc)) + 100 - plain arrays are assumed to be in 1 / Mpc"""
+        if is_astropy_quantity(k_array):
+            k_array = k_array.to_value(1. / u.Mpc)
+        return np.log10(k_array) + 100.
 
     def _set_interpolating_function(self,k_min,k_max):
         k_raw_reduced_bool_arr = (self.k_raw >= (k_min-(1.e-3/u.Mpc))) * (self.k_raw <= (k_max+(1.e-3/u.Mpc)))
         k_reduced,power_reduced = self._form_reduced_arrays(self.k_raw[k_raw_reduced_bool_arr],self.power_raw[k_raw_reduced_bool_arr])
         self._interpolating_func=spp.interp1d(self._correction_for_interpolation(k_reduced),power_reduced,kind='cubic')
 
+    def _set_evaluation_range(self, k_min, k_max):
+        """Fix the interpolation range when evaluating in slabs, so that every slab uses the same interpolant"""
+        if k_min is None:
+            self._evaluation_range = None
+        else:
+            if not is_astropy_quantity(k_min):
+                k_min, k_max = k_min / u.Mpc, k_max / u.Mpc
+            self._evaluation_range = (k_min.to(1. / u.Mpc), k_max.to(1. / u.Mpc))
+            self._set_interpolating_function(*self._evaluation_range)
+
     def evaluate3d_isotropic(self, k):
-        k_modified = k.to(1. / u.Mpc)
-        k_modified[k == 0.] = np.min(k_modified[k_modified > 0. / u.Mpc])
-        self._set_interpolating_function(np.min(k_modified),np.max(k_modified))
+        if is_astropy_quantity(k):
+            k_modified = np.array(k.to_value(1. / u.Mpc), dtype=np.float64)
+        else: #Unit-free fast path - k in 1 / Mpc
+            k_modified = np.array(k, dtype=np.float64)
+        k_modified[k_modified == 0.] = np.min(k_modified[k_modified > 0.])
+        if self._evaluation_range is None:
+            self._set_interpolating_function(np.min(k_modified) / u.Mpc, np.max(k_modified) / u.Mpc)
         power_interpolated = self._interpolating_func(self._correction_for_interpolation(k_modified))
         power_interpolated[k == 0.] = 0.
         return power_interpolated
@@ -37,7 +37,6 @@ if __name__ == "__main__":
     simulation_box_instance.convert_fourier_units_to_distance = True
     delta_flux_box = simulation_box_instance.skewers_realisation()
     k_box = simulation_box_instance.k_box()
-    mu_box = simulation_box_instance.mu_box()
 
     #Binning to match GenPK
     n_k_bins = 15
@@ -46,6 +45,7 @@ if __name__ == "__main__":
     k_bin_edges = get_k_bin_edges_logspace(n_k_bins, k_box)
     mu_bin_edges = get_mu_bin_edges_linspace(n_mu_bins)
 
+    binning_plan = fou.BinningPlan(simulation_box_instance, k_bin_edges, mu_bin_edges)
     fourier_estimator_instance = fou.FourierEstimator3D(delta_flux_box)
-    power_binned, k_binned, mu_binned, bin_counts = fourier_estimator_instance.get_power_3D_two_coords_binned(k_box,np.absolute(mu_box),k_bin_edges,mu_bin_edges,count=True)
+    power_binned, k_binned, mu_binned, bin_counts = fourier_estimator_instance.get_power_3D_plan_binned(binning_plan,count=True)
     np.savez(SPECTRA_SAVEDIR + POWER_SPECTRA_SAVEFILE, power_binned, k_binned, mu_binned, bin_counts)
\ No newline at end of file
@@ -38,7 +38,6 @@ if __name__ == "__main__":
 
     #Co-ordinate boxes
     k_box = test_gaussian_ins_sub_sampled.k_box()
-    mu_box = test_gaussian_ins_sub_sampled.mu_box()
 
     #Binning
     k_min = np.min(k_box[k_box > 0. / u.Mpc])
@@ -47,6 +46,7 @@ if __name__ == "__main__":
     k_bin_edges = np.exp(np.linspace(mh.log(k_min.value), mh.log(k_bin_max.value), n_k_bins + 1)) / u.Mpc
     #k_bin_edges[-2] = k_max
     mu_bin_edges = np.linspace(0., 1., n_mu_bins + 1)
+    binning_plan = fou.BinningPlan(test_gaussian_ins_sub_sampled, k_bin_edges, mu_bin_edges) #Shared by both boxes
 
     #Gaussian boxes
     '''test_gaussian_box = test_gaussian_ins.anisotropic_pre_computed_gauss_realisation(model_cosmology_filename, mu_coefficients)
@@ -71,8 +71,8 @@ if __name__ == "__main__":
     fourier_estimator_instance_dodged = fou.FourierEstimator3D(test_gaussian_box_dodged)
 
     #Power spectra
-    power_bin,k_bin,bin_count = fourier_estimator_instance.get_power_3D_two_coords_binned(k_box, np.absolute(mu_box), k_bin_edges, mu_bin_edges, bin_coord2=False, std_err=False)
-    power_bin_dodged = fourier_estimator_instance_dodged.get_power_3D_two_coords_binned(k_box, np.absolute(mu_box), k_bin_edges, mu_bin_edges, bin_coord1=False, bin_coord2=False, count=False, std_err=False)
+    power_bin,k_bin,bin_count = fourier_estimator_instance.get_power_3D_plan_binned(binning_plan, bin_coord2=False, count=True, std_err=False)
+    power_bin_dodged = fourier_estimator_instance_dodged.get_power_3D_plan_binned(binning_plan, bin_coord1=False, bin_coord2=False, count=False, std_err=False)[0]
 
     '''power_unbinned = fourier_estimator_instance.get_flux_power_3D()
     power_unbinned_dodged = fourier_estimator_instance_dodged.get_flux_power_3D()'''
@@ -1,3 +1,6 @@
+import collections
+import hashlib
+import os
 import math as mh
 import random as rd
 import numpy as np
@@ -5,9 +8,11 @@ import numpy.random as npr
 import scipy.stats as spt
 import scipy.integrate as spi
 import scipy.special as sps
+import scipy.fft as spf
 import copy as cp
 import astropy.units as u
 import astropy.constants as c
+import h5py
 
 from fake_spectra import spectra as sa
 from fake_spectra import griddedspectra as gs
@@ -15,6 +20,29 @@ from fake_spectra import randspectra as rs
 
 import sys
 
+FLOAT_DTYPES = {'single': np.float32, 'double': np.float64}
+COMPLEX_DTYPES = {'single': np.complex64, 'double': np.complex128}
+VOIGT_TEMPLATE_CACHE_SIZE = 32
+
+def get_float_dtype(precision):
+    return FLOAT_DTYPES[precision]
+
+def get_complex_dtype(precision):
+    return COMPLEX_DTYPES[precision]
+
+def get_fft_module(precision):
+    """numpy.fft always transforms in double precision - scipy.fft keeps single-precision input in single precision"""
+    if precision == 'single':
+        return spf
+    else:
+        return np.fft
+
+def cast_to_precision(array, precision):
+    if np.iscomplexobj(array):
+        return array.astype(get_complex_dtype(precision), copy=False)
+    else:
+        return array.astype(get_float_dtype(precision), copy=False)
+
 def sort_3D_to_1D(array_3D, args_1D):
     return array_3D.flatten()[args_1D]
 
@@ -32,17 +60,84 @@ def bin_1D_data(array_1D, n_bins):
 def bin_2D_data(array_2D, n_bins):
     return np.mean(arrange_data_in_3D(array_2D, n_bins), axis=-1)
 
+def get_bin_edges(bins, coord_min, coord_max):
+    """Bin edges from a number of bins over [coord_min, coord_max] (as scipy.stats.binned_statistic_2d) or from edges"""
+    if np.ndim(bins) > 0:
+        return np.array(bins)
+    if coord_min == coord_max:
+        coord_min = coord_min - 0.5
+        coord_max = coord_max + 0.5
+    return np.linspace(coord_min, coord_max, bins + 1)
+
+def digitise_x_y(x, y, x_bin_edges, y_bin_edges):
+    """Flattened 2D bin index of each (x, y) sample - as scipy.stats.binned_statistic_2d, the last bins include their
+    right edges - with -1 for samples outside the bins"""
+    bin_index = []
+    for coord, bin_edges in ((x, x_bin_edges), (y, y_bin_edges)):
+        coord_bin_index = np.searchsorted(bin_edges, coord, side='right') - 1
+        coord_bin_index[coord == bin_edges[-1]] = bin_edges.size - 2
+        coord_bin_index[coord_bin_index > bin_edges.size - 2] = -1
+        bin_index.append(coord_bin_index)
+    flat_bin_index = (bin_index[0] * (y_bin_edges.size - 1)) + bin_index[1]
+    flat_bin_index[(bin_index[0] < 0) | (bin_index[1] < 0)] = -1
+    return flat_bin_index
+
+def bin_f_index_statistics(bin_index, f, n_bins, weights=None):
+    """Mean, count and standard error of the mean of f grouped by a (non-negative) integer bin index, by np.bincount.
+    Samples may be counted weights times."""
+    bin_index, f = np.ravel(bin_index), np.ravel(get_value(f))
+    if weights is None:
+        weighted_bin_sum = lambda values: np.bincount(bin_index, weights=values, minlength=n_bins)
+        counts = np.bincount(bin_index, minlength=n_bins).astype(np.float64)
+    else:
+        weights = np.ravel(weights)
+        weighted_bin_sum = lambda values: np.bincount(bin_index, weights=values * weights, minlength=n_bins)
+        counts = np.bincount(bin_index, weights=weights, minlength=n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        f_mean = weighted_bin_sum(f) / counts
+        f_variance = weighted_bin_sum((f - f_mean[bin_index]) ** 2) / (counts - 1.)
+        return f_mean, counts, np.sqrt(f_variance / counts)
+
+def bin_f_x_y_histogram_statistics(x, y, f, n_bins_x, n_bins_y, weights=None):
+    """
+    Digitise (x, y) once and accumulate with np.bincount. Returns the mean, count, standard error of the mean of f
+    and the mean x and y in each bin. Samples may be counted weights times (e.g. half-spectrum modes weighted by the
+    number of full-spectrum modes they represent). Bins as scipy.stats.binned_statistic_2d (numbers of bins or edges).
+    """
+    x, y, f = [np.ravel(get_value(values)) for values in (x, y, f)]
+    x_bin_edges = get_bin_edges(n_bins_x, np.min(x), np.max(x))
+    y_bin_edges = get_bin_edges(n_bins_y, np.min(y), np.max(y))
+    bins_shape = (x_bin_edges.size - 1, y_bin_edges.size - 1)
+
+    bin_index = digitise_x_y(x, y, x_bin_edges, y_bin_edges)
+    in_bins = bin_index >= 0
+    if not np.all(in_bins):
+        bin_index, x, y, f = bin_index[in_bins], x[in_bins], y[in_bins], f[in_bins]
+        if weights is not None:
+            weights = np.ravel(weights)[in_bins]
+    f_mean, counts, f_std_err = bin_f_index_statistics(bin_index, f, bins_shape[0] * bins_shape[1], weights=weights)
+    if weights is not None:
+        x, y = x * np.ravel(weights), y * np.ravel(weights)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = np.bincount(bin_index, weights=x, minlength=counts.size) / counts
+        y_mean = np.bincount(bin_index, weights=y, minlength=counts.size) / counts
+    return tuple(statistic.reshape(bins_shape) for statistic in (f_mean, counts, f_std_err, x_mean, y_mean))
+
 def bin_f_x_y_histogram(x, y, f, n_bins_x, n_bins_y):
-    return spt.binned_statistic_2d(x, y, f, statistic = 'mean', bins = [n_bins_x, n_bins_y])[0]
+    return bin_f_x_y_histogram_statistics(x, y, f, n_bins_x, n_bins_y)[0]
 
 def standard_error(array_1D):
     return np.std(array_1D, ddof=1) / mh.sqrt(array_1D.size)
 
 def bin_f_x_y_histogram_standard_error(x, y, f, n_bins_x, n_bins_y):
-    return spt.binned_statistic_2d(x, y, f, statistic = standard_error, bins=[n_bins_x, n_bins_y])[0]
+    return bin_f_x_y_histogram_statistics(x, y, f, n_bins_x, n_bins_y)[2]
 
 def bin_f_x_y_histogram_count(x, y, f, n_bins_x, n_bins_y):
-    return spt.binned_statistic_2d(x, y, f, statistic='count', bins=[n_bins_x, n_bins_y])[0]
+    return bin_f_x_y_histogram_statistics(x, y, f, n_bins_x, n_bins_y)[1]
+
+def bin_f_x_y_histogram_weighted(x, y, f, weights, n_bins_x, n_bins_y):
+    """Mean, count and standard error of f in bins with each sample counted weights times"""
+    return bin_f_x_y_histogram_statistics(x, y, f, n_bins_x, n_bins_y, weights=weights)[:3]
 
 def get_end_index(bin_size):
     if bin_size == 1:
@@ -56,12 +151,78 @@ def calculate_local_average_of_array(array_nD, bin_size):
         array_nD_local_average[..., i] = np.roll(array_nD, -1 * i, axis = -1)
     return np.mean(array_nD_local_average, axis = -1)[..., :get_end_index(bin_size)]
 
+def update_running_statistics(running_statistics, samples, covariance=False):
+    """Merge a chunk of samples [n_samples, n_variables] into running (count, mean, sum of squared deviations - or the
+    co-moment matrix if covariance) by the pairwise update of Welford's algorithm. Start from running_statistics=None"""
+    samples = np.asarray(samples, dtype=np.float64)
+    n_chunk = samples.shape[0]
+    if n_chunk == 0:
+        return running_statistics
+    mean_chunk = np.mean(samples, axis=0)
+    deviations = samples - mean_chunk
+    if covariance:
+        m2_chunk = np.dot(deviations.T, deviations)
+    else:
+        m2_chunk = np.sum(deviations ** 2, axis=0)
+    if running_statistics is None:
+        return n_chunk, mean_chunk, m2_chunk
+    n_running, mean_running, m2_running = running_statistics
+    n_total = n_running + n_chunk
+    delta = mean_chunk - mean_running
+    if covariance:
+        delta_squared = np.outer(delta, delta)
+    else:
+        delta_squared = delta ** 2
+    return n_total, mean_running + (delta * (n_chunk / n_total)), m2_running + m2_chunk + (delta_squared * (n_running * n_chunk / n_total))
+
+def hdf5_dataset_chunks(fname, dataset_name, chunk_size=1000):
+    """Yield the rows of an HDF5 dataset (e.g. 'tau/H/1/1215' in a fake_spectra savefile) chunk_size at a time"""
+    with h5py.File(fname, 'r') as hdf5_file:
+        dataset = hdf5_file[dataset_name]
+        for i in range(0, dataset.shape[0], chunk_size):
+            yield dataset[i: i + chunk_size]
+
+def open_grid_k_mu_slab(k_open_grid, x_start, x_stop):
+    """|k| and mu for the x-slab [x_start, x_stop) of an open grid of broadcastable (k_x, k_y, k_z) axes"""
+    k_x, k_y, k_z = k_open_grid
+    k = np.sqrt(k_x[x_start:x_stop] ** 2 + k_y ** 2 + k_z ** 2)
+    mu = k_z / k
+    mu[k == 0.] = np.nan
+    return k, mu
+
+def open_grid_shape(k_open_grid):
+    return tuple(k_open_grid[i].shape[i] for i in range(3))
+
+def open_grid_k_range(k_open_grid):
+    """Smallest non-zero and largest |k| on an open grid"""
+    k_axes_no0 = [np.absolute(k_i[k_i != 0.]) for k_i in k_open_grid]
+    k_min = min([np.min(k_i) for k_i in k_axes_no0 if k_i.size > 0])
+    k_max = np.sqrt(np.max(np.absolute(k_open_grid[0])) ** 2 + np.max(np.absolute(k_open_grid[1])) ** 2 + np.max(np.absolute(k_open_grid[2])) ** 2)
+    return k_min, k_max
+
 def is_astropy_quantity(var):
     return hasattr(var, 'value')
 
+def unique_with_inverse(array):
+    """Unique values of an array (keeping any units) and the inverse index in the shape of the array"""
+    unique_values, inverse_index = np.unique(get_value(array), return_inverse=True)
+    if is_astropy_quantity(array):
+        unique_values = unique_values * array.unit
+    return unique_values, inverse_index.reshape(np.shape(array))
+
+def get_value(var):
+    """Strip units (if any) - plain arrays are assumed to already be in the internal units"""
+    if is_astropy_quantity(var):
+        return var.value
+    else:
+        return var
+
 def evaluate_legendre_polynomial(array, multipole):
     legendre_polynomial = sps.legendre(multipole) #l-th order Legendre polynomial
-    return legendre_polynomial(array.value) * u.dimensionless_unscaled
+    if is_astropy_quantity(array):
+        return legendre_polynomial(array.value) * u.dimensionless_unscaled
+    else:
+        return legendre_polynomial(array)
 
 def spherical_to_cylindrical_coordinates(k,mu):
     k_para = k * mu
@@ -74,10 +235,62 @@ def voigt(x, sigma, gamma, x0):
     Return the Voigt line shape at x with Lorentzian component HWHM gamma
     and Gaussian component std dev sigma.
     """
-    return np.real(sps.wofz((x.value - x0.value + 1j*gamma.value)/sigma.value/np.sqrt(2))) / sigma /np.sqrt(2*np.pi)
+    return np.real(sps.wofz((get_value(x) - get_value(x0) + 1j*get_value(gamma))/get_value(sigma)/np.sqrt(2))) / sigma /np.sqrt(2*np.pi)
+
+def voigt_fourier_transform(k, sigma, gamma, x0):
+    """Return the (continuous) Fourier transform of the unit-normalised Voigt profile at k - a Gaussian times an
+    exponential - for a line centred at x0."""
+    return np.exp((-0.5 * ((sigma * k) ** 2)) - (gamma * np.absolute(k)) - (1.j * k * x0))
 
 def voigt_amplified(x, sigma, gamma, amp, x0):
-    return (amp * voigt(x, sigma, gamma, x0)) / voigt(x0, sigma, gamma, x0)
+    return (amp * voigt(x, sigma, gamma, x0)) / voigt(0., sigma, gamma, 0.)
+
+#Voigt profile templates
+_voigt_template_cache = collections.OrderedDict()
+
+def _value_in_units_of(var, reference):
+    if is_astropy_quantity(var) and is_astropy_quantity(reference):
+        return var.to_value(reference.unit)
+    else:
+        return get_value(var)
+
+def voigt_template(sigma, gamma, dv, x_max, oversampling=10, cache_dir=None):
+    """
+    Return the unit-normalised Voigt profile tabulated (without units) at 0 <= x <= x_max on a grid of spacing
+    dv / oversampling. Templates are held in an LRU cache keyed by (sigma, gamma, dv) - and optionally saved in
+    cache_dir - and are re-tabulated only if a larger x_max is requested.
+    """
+    sigma, gamma, x_max = [_value_in_units_of(var, dv) for var in (sigma, gamma, x_max)]
+    template_key = (float(sigma), float(gamma), float(get_value(dv)), int(oversampling))
+    grid_spacing = template_key[2] / oversampling
+    template = _voigt_template_cache.pop(template_key, None)
+    fname = None
+    if cache_dir is not None:
+        fname = os.path.join(cache_dir, 'voigt_template_%s.npy' % hashlib.md5(repr(template_key).encode()).hexdigest())
+        if template is None and os.path.exists(fname):
+            template = np.load(fname)
+    if template is None or ((template.size - 1) * grid_spacing) < x_max:
+        template = voigt(np.arange(int(np.ceil(x_max / grid_spacing)) + 1) * grid_spacing, template_key[0], template_key[1], 0.)
+        if fname is not None:
+            np.save(fname, template)
+    _voigt_template_cache[template_key] = template
+    while len(_voigt_template_cache) > VOIGT_TEMPLATE_CACHE_SIZE:
+        _voigt_template_cache.popitem(last=False)
+    return template
+
+def clear_voigt_template_cache():
+    _voigt_template_cache.clear()
+
+def voigt_from_template(x, sigma, gamma, x0, dv, oversampling=10, cache_dir=None):
+    """As voigt (but without units) by shifting and interpolating a cached template - exact if x - x0 is a multiple
+    of dv / oversampling"""
+    offsets = np.absolute(_value_in_units_of(x, dv) - _value_in_units_of(x0, dv))
+    template = voigt_template(sigma, gamma, dv, np.max(offsets), oversampling=oversampling, cache_dir=cache_dir)
+    return np.interp(offsets, np.arange(template.size) * get_value(dv) / oversampling, template)
+
+def voigt_amplified_from_template(x, sigma, gamma, amp, x0, dv, oversampling=10, cache_dir=None):
+    profile = voigt_from_template(x, sigma, gamma, x0, dv, oversampling=oversampling, cache_dir=cache_dir)
+    return amp * profile / voigt_template(sigma, gamma, dv, 0., oversampling=oversampling, cache_dir=cache_dir)[0]
 
 def full_voigt_optical_depth(velocity_samples, column_density, central_velocity, central_wavelength = 1215.67 * u.Angstrom):
     gas_temperature = 1.e+4 * u.K
@@ -101,6 +314,30 @@ def full_voigt_optical_depth(velocity_samples, column_density, central_velocity,
 
     return optical_depth, del_lambda_D, z, wavelength_samples
 
+def sample_column_densities(n_samples, cddf, column_density_bin_edges, rng=None, log10_edges=False):
+    """Draw column densities [cm^-2] from a column density distribution given as histogram counts in bins -
+    log-uniformly within each bin. The bin edges are column densities [cm^-2], or log10 of them if log10_edges (as
+    saved by plot_forest.plot_CDDF - see load_CDDF)"""
+    if rng is None:
+        rng = npr
+    bin_probabilities = np.asarray(cddf, dtype=np.float64) / np.sum(cddf)
+    bin_index = rng.choice(bin_probabilities.size, n_samples, replace=True, p=bin_probabilities)
+    if log10_edges:
+        log_bin_edges = np.asarray(get_value(column_density_bin_edges), dtype=np.float64)
+    else:
+        log_bin_edges = np.log10(_value_in_units_of(column_density_bin_edges, 1. / (u.cm ** 2)))
+    log_column_densities = log_bin_edges[bin_index] + (rng.uniform(size=n_samples) * np.diff(log_bin_edges)[bin_index])
+    return (10. ** log_column_densities) / (u.cm ** 2)
+
+def load_CDDF(fname):
+    """Return the histogram counts and log10 column density [cm^-2] bin edges of a CDDF saved by plot_forest.plot_CDDF"""
+    with np.load(fname, allow_pickle=True) as cddf_file:
+        histogram_bin_edges = cddf_file['arr_1']
+        cddf = cddf_file['arr_0']
+        if cddf.dtype == object: #np.histogram (counts, edges) tuple
+            cddf = cddf[0]
+        return np.asarray(cddf, dtype=np.float64), histogram_bin_edges
+
 def voigt_power_spectrum(spectrum_length, velocity_bin_width, mean_flux, column_density = None, sigma = None, gamma = None, amp = None):
     n_velocity_samples = spectrum_length / velocity_bin_width
     velocity_samples = np.arange(-1 * n_velocity_samples / 2, n_velocity_samples / 2 + 1) * velocity_bin_width
@@ -114,6 +351,62 @@ def voigt_power_spectrum(spectrum_length, velocity_bin_width, mean_flux, column_
     k_samples = np.fft.rfftfreq(delta_flux.shape[0], d = velocity_bin_width) * 2. * mh.pi
     return (np.real(delta_flux_FT)**2 + np.imag(delta_flux_FT)**2) * spectrum_length, k_samples, velocity_samples, optical_depth, del_lambda_D, z, wavelength_samples, delta_flux_FT, delta_flux
 
+def voigt_power_spectra(spectrum_length, velocity_bin_width, mean_flux, column_densities, batch_size=1000):
+    """Vectorised voigt_power_spectrum over an array of column densities. Optical depth is linear in column density,
+    so the line profile is evaluated only once. Returns the power spectra and flux Fourier transforms (a row per
+    column density) and the k samples."""
+    n_velocity_samples = spectrum_length / velocity_bin_width
+    velocity_samples = np.arange(-1 * n_velocity_samples / 2, n_velocity_samples / 2 + 1) * velocity_bin_width
+    optical_depth_unit_column = full_voigt_optical_depth(velocity_samples, 1. / (u.cm ** 2), 0. * u.km / u.s)[0].value
+    column_densities = np.atleast_1d(_value_in_units_of(column_densities, 1. / (u.cm ** 2)))
+    delta_flux_FT = np.empty((column_densities.shape[0], (velocity_samples.shape[0] // 2) + 1), dtype=np.complex128)
+    for batch_start in range(0, column_densities.shape[0], batch_size):
+        batch = slice(batch_start, batch_start + batch_size)
+        delta_flux = np.exp(-1. * column_densities[batch][:, np.newaxis] * optical_depth_unit_column[np.newaxis, :]) / mean_flux - 1.
+        delta_flux_FT[batch] = np.fft.rfft(delta_flux, axis=-1) / delta_flux.shape[-1]
+    k_samples = np.fft.rfftfreq(velocity_samples.shape[0], d = velocity_bin_width) * 2. * mh.pi
+    return (np.real(delta_flux_FT)**2 + np.imag(delta_flux_FT)**2) * spectrum_length, k_samples, delta_flux_FT
+
+def voigt_F_HCD(spectrum_length, velocity_bin_width, mean_flux, column_densities, cddf_weights, batch_size=1000):
+    """Return the k samples and F_Voigt(k_parallel) - the flux Fourier transform of Voigt profiles (centred in the
+    spectrum) integrated over column density weighted by the CDDF"""
+    k_samples, delta_flux_FT = voigt_power_spectra(spectrum_length, velocity_bin_width, mean_flux, column_densities, batch_size=batch_size)[1:]
+    sign_correction_array = np.ones(k_samples.shape[0])
+    sign_correction_array[::2] = -1.
+    F_Voigt = spi.trapz(delta_flux_FT * sign_correction_array * np.asarray(cddf_weights)[:, np.newaxis], _value_in_units_of(column_densities, 1. / (u.cm ** 2)), axis=0)
+    return k_samples, F_Voigt
+
+def save_F_Voigt_template_bank(fname, spectrum_length, velocity_bin_widths, mean_fluxes, redshifts, column_density_ranges, column_densities, cddf_weights, batch_size=1000):
+    """
+    Save F_Voigt(k_parallel) templates indexed by (column density range, redshift, velocity bin) to a single .npz file.
+    Column densities and CDDF weights are the samples to integrate over; each redshift has its own mean flux. The flux
+    Fourier transforms are computed once per velocity bin since the mean flux only rescales them.
+    """
+    column_density_values = _value_in_units_of(column_densities, 1. / (u.cm ** 2))
+    column_density_ranges = np.array([[_value_in_units_of(limit, 1. / (u.cm ** 2)) for limit in column_density_range] for column_density_range in column_density_ranges])
+    bank = {'velocity_bin_widths': np.array([_value_in_units_of(width, u.km / u.s) for width in velocity_bin_widths]), 'redshifts': np.asarray(redshifts),
+            'mean_fluxes': np.asarray(mean_fluxes), 'column_density_ranges': column_density_ranges}
+    for i, velocity_bin_width in enumerate(velocity_bin_widths):
+        k_samples, flux_FT = voigt_power_spectra(spectrum_length, velocity_bin_width, 1., column_density_values, batch_size=batch_size)[1:]
+        flux_FT[:, 0] += 1.
+        sign_correction_array = np.ones(k_samples.shape[0])
+        sign_correction_array[::2] = -1.
+        F_Voigt = np.empty((column_density_ranges.shape[0], len(mean_fluxes), k_samples.shape[0]), dtype=np.complex128)
+        for j, column_density_range in enumerate(column_density_ranges):
+            in_range = (column_density_values >= column_density_range[0]) * (column_density_values < column_density_range[1])
+            for l, mean_flux in enumerate(mean_fluxes):
+                delta_flux_FT = flux_FT[in_range] / mean_flux
+                delta_flux_FT[:, 0] -= 1.
+                F_Voigt[j, l] = spi.trapz(delta_flux_FT * sign_correction_array * np.asarray(cddf_weights)[in_range, np.newaxis], column_density_values[in_range], axis=0)
+        bank['k_samples_%i' % i] = _value_in_units_of(k_samples, u.s / u.km)
+        bank['F_Voigt_%i' % i] = F_Voigt
+    np.savez(fname, **bank)
+
+def load_F_Voigt_template(fname, column_density_range_index, redshift_index, velocity_bin_index):
+    """Return k_parallel [s / km] and F_Voigt from a template bank saved by save_F_Voigt_template_bank"""
+    with np.load(fname) as bank:
+        return bank['k_samples_%i' % velocity_bin_index], bank['F_Voigt_%i' % velocity_bin_index][column_density_range_index, redshift_index]
+
 def _set_real_values_in_hermitian_box(box, x, y, z):
     box[0, 0, 0] = np.real(box[0, 0, 0]) * mh.sqrt(2.)
     if x % 2 == 0:
@@ -135,6 +428,35 @@ def make_box_hermitian(box):
                 box[i, j, k] = np.conj(box[-i, -j, -k])
     return box
 
+def half_spectrum_mode_weights(n_z):
+    """Number of full-spectrum modes represented by each rfftn mode along z: 2 except on the k_z = 0 (and Nyquist)
+    planes"""
+    mode_weights = np.full((n_z // 2) + 1, 2.)
+    mode_weights[0] = 1.
+    if n_z % 2 == 0:
+        mode_weights[-1] = 1.
+    return mode_weights
+
+def make_plane_hermitian(plane):
+    """Symmetrise a 2D plane of modes so that plane[i, j] = conj(plane[-i, -j]), preserving the variance per mode"""
+    plane_reflected = np.conj(plane[(-1 * np.arange(plane.shape[0])) % plane.shape[0]][:, (-1 * np.arange(plane.shape[1])) % plane.shape[1]])
+    return (plane + plane_reflected) / mh.sqrt(2.)
+
+def make_half_box_hermitian(half_box, z):
+    """Enforce the Hermitian constraints of a half-spectrum (rfftn-ordered) box with z samples along the last axis"""
+    half_box[:, :, 0] = make_plane_hermitian(half_box[:, :, 0])
+    if z % 2 == 0:
+        half_box[:, :, -1] = make_plane_hermitian(half_box[:, :, -1]) #Nyquist plane
+    return half_box
+
+def fix_mode_amplitudes(box, gauss_amplitude, zero_mode_bool_arr):
+    """Rescale (Hermitian) modes to fixed amplitude sqrt(2) * gauss_amplitude = sqrt(P), keeping only their phases"""
+    box_modulus = np.absolute(box)
+    with np.errstate(invalid='ignore'): #Amplitude of the zero mode can be infinite
+        box = np.divide(box, box_modulus, out=np.zeros_like(box), where=(box_modulus > 0.)) * gauss_amplitude * mh.sqrt(2.)
+    box[zero_mode_bool_arr] = 0. #Zeroing the mean
+    return box
+
 def gen_log_space(limit, n): #Courtesy of http://stackoverflow.com/questions/12418234/logarithmically-spaced-integers
     result = [1]
     if n>1:  # just a check to avoid ZeroDivisionError
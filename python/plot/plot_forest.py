@@ -62,7 +62,7 @@ def plot_CDDF(plotname, cddf_savename, simulation_box_instance, load_cddf=False)
 
         histogram_bin_edges = np.arange(mh.floor(np.min(column_density_log10_cm2_no0)), mh.ceil(np.max(column_density_log10_cm2_no0))+0.1, 0.1)
         cddf = np.histogram(column_density_log10_cm2_no0, bins=histogram_bin_edges)
-        np.savez(cddf_savename, cddf, histogram_bin_edges)
+        np.savez(cddf_savename, np.array(cddf, dtype=object), histogram_bin_edges)
 
         #axis.hist(column_density.flatten(), bins='auto', normed=True, histtype='step')
         #axis.set_xscale('log')
@@ -70,7 +70,7 @@ def plot_CDDF(plotname, cddf_savename, simulation_box_instance, load_cddf=False)
 
         return column_density
     else:
-        cddf_file = np.load(cddf_savename)
+        cddf_file = np.load(cddf_savename, allow_pickle=True)
         cddf = cddf_file['arr_0']
         histogram_bin_edges = cddf_file['arr_1']
         npt.assert_array_equal(cddf[1], histogram_bin_edges)
@@ -143,17 +143,18 @@ def plot_power_spectra(plotname, power_spectra_savename, simulation_box_instance
 
     return k
 
-def bin_matter_power_spectrum(n_k_bins, n_mu_bins, simulation_box_instance, cosmo_name='base_plikHM_TTTEEE_lowTEB_2015', savename=None):
+def bin_matter_power_spectrum(n_k_bins, n_mu_bins, simulation_box_instance, cosmo_name='base_plikHM_TTTEEE_lowTEB_2015', savename=None, binning_plan=None):
     simulation_box_instance.convert_fourier_units_to_distance = True
     redshift = simulation_box_instance._redshift
     k = simulation_box_instance.k_box()
-    mu = np.absolute(simulation_box_instance.mu_box())
     hubble_constant = simulation_box_instance.spectra_instance.hubble
 
-    k_bin_edges = sav.get_k_bin_edges_logspace(n_k_bins, k)
-    mu_bin_edges = sav.get_mu_bin_edges_linspace(n_mu_bins)
+    if binning_plan is None:
+        k_bin_edges = sav.get_k_bin_edges_logspace(n_k_bins, k)
+        mu_bin_edges = sav.get_mu_bin_edges_linspace(n_mu_bins)
+        binning_plan = fou.BinningPlan(simulation_box_instance, k_bin_edges, mu_bin_edges)
 
-    power = fou.get_matter_power_spectrum_two_coords_binned(redshift, k, k, mu, k_bin_edges, mu_bin_edges, hubble_constant, cosmology_name=cosmo_name)
+    power = fou.get_matter_power_spectrum_two_coords_binned(redshift, k, hubble_constant, cosmology_name=cosmo_name, binning_plan=binning_plan)
     if savename is not None:
         np.save(savename, power)
     return power
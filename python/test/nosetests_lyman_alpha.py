@@ -1,8 +1,10 @@
 import os
 import sys
+import tempfile
 import numpy as np
 import numpy.random as npr
 import numpy.testing as npt
+import scipy.stats as spt
 import astropy.units as u
 
 from main import *
@@ -19,6 +21,65 @@ def test_gauss_realisation():
     test_gaussian_realisation = test_gaussian_box._gauss_realisation(np.zeros_like(k_samples.value),k_samples)
     npt.assert_array_equal(test_gaussian_realisation,np.zeros((test_n_samples['x'],test_n_samples['y'],test_n_samples['z'])))
 
+def test_gauss_realisation_real_fft():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_n_samples = {'x': 25, 'y': 24, 'z': 12}
+    test_gaussian_box = GaussianBox(test_box_size, test_n_samples, 3.993, (70.4 * u.km) / (u.s * u.Mpc), 0.2726)
+    test_gaussian_box.use_real_fft = True
+    test_gaussian_realisation = test_gaussian_box.isotropic_power_law_gauss_realisation(-1., 1. / u.Mpc, 1.)
+    assert test_gaussian_realisation.dtype == np.float64
+    assert test_gaussian_realisation.shape == (test_n_samples['x'], test_n_samples['y'], test_n_samples['z'])
+    assert np.absolute(np.mean(test_gaussian_realisation)) < 1.e-16
+
+def test_out_of_core_gauss_realisation():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_n_samples = {'x': 20, 'y': 15, 'z': 12}
+    test_gaussian_box = GaussianBox(test_box_size, test_n_samples, 3.993, (70.4 * u.km) / (u.s * u.Mpc), 0.2726)
+    test_power_spectrum = PowerLawPowerSpectrum(-1., 1. / u.Mpc, 1.)
+    test_dir = tempfile.mkdtemp()
+    test_one_slab_realisation = test_gaussian_box.out_of_core_gauss_realisation(test_power_spectrum, os.path.join(test_dir, 'one_slab.npy'), rng=npr.default_rng(0))
+    test_multi_slab_realisation = test_gaussian_box.out_of_core_gauss_realisation(test_power_spectrum, os.path.join(test_dir, 'multi_slab.npy'), memory_budget=3.e+4, rng=npr.default_rng(0)) #A few planes per slab
+    npt.assert_allclose(test_multi_slab_realisation, test_one_slab_realisation, atol=1.e-15)
+    test_x_step_realisation = test_gaussian_box.out_of_core_gauss_realisation(test_power_spectrum, os.path.join(test_dir, 'x_step.npy'), memory_budget=3.e+4, x_step=2, rng=npr.default_rng(0))
+    npt.assert_allclose(test_x_step_realisation, test_one_slab_realisation[::2], atol=1.e-15)
+
+    test_gaussian_box.use_real_fft = True
+    k_half_box = test_gaussian_box.k_box()[..., :7]
+    power_expected = get_value(test_power_spectrum.evaluate3d_isotropic(k_half_box))
+    power_expected[0, 0, 0] = 0.
+    power_ratio = np.absolute(np.fft.rfftn(test_one_slab_realisation)) ** 2 / power_expected
+    assert np.absolute(np.nanmean(power_ratio[:, :, 1:-1]) - 1.) < 0.15
+    test_gaussian_box.fixed_amplitude = True
+    test_gaussian_box.paired_realisations = True
+    test_fixed_realisation, test_fixed_partner = test_gaussian_box.out_of_core_gauss_realisation(test_power_spectrum, os.path.join(test_dir, 'fixed.npy'), memory_budget=3.e+4, rng=npr.default_rng(1))
+    npt.assert_allclose(np.absolute(np.fft.rfftn(test_fixed_realisation)) ** 2, power_expected, rtol=1.e-10, atol=1.e-15)
+    npt.assert_array_equal(test_fixed_partner, -1. * test_fixed_realisation)
+def test_gauss_realisation_ensemble_reproducible():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 10, 'y': 12, 'z': 8}, 3.993, (70.4 * u.km) / (u.s * u.Mpc), 0.2726)
+    test_gaussian_box.use_real_fft = True
+    test_power_spectrum = PowerLawPowerSpectrum(-1., 1. / u.Mpc, 1.)
+    test_ensemble_serial = test_gaussian_box.gauss_realisation_ensemble(test_power_spectrum, 3, seed=42)
+    test_ensemble_parallel = test_gaussian_box.gauss_realisation_ensemble(test_power_spectrum, 3, seed=42, n_processes=2)
+    npt.assert_array_equal(np.array(test_ensemble_serial), np.array(test_ensemble_parallel))
+    assert not np.array_equal(test_ensemble_serial[0], test_ensemble_serial[1])
+    worker_box = test_gaussian_box._ensemble_worker_box()
+    assert (len(test_gaussian_box._coordinate_grid_cache) > 0) and (len(worker_box._coordinate_grid_cache) == 0)
+
+def test_paired_fixed_amplitude_gauss_realisation():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 10, 'y': 11, 'z': 8}, 3.993, (70.4 * u.km) / (u.s * u.Mpc), 0.2726)
+    test_gaussian_box.convert_fourier_units_to_distance = True
+    test_gaussian_box.use_real_fft = True
+    test_gaussian_box.fixed_amplitude = True
+    test_gaussian_box.paired_realisations = True
+    k_samples = test_gaussian_box.k_box()
+    power_evaluated = PowerLawPowerSpectrum(-1., 1. / u.Mpc, 1.).evaluate3d_isotropic(k_samples).value
+    power_evaluated[k_samples == 0.] = 0.
+    test_gaussian_realisation, test_gaussian_realisation_paired = test_gaussian_box.isotropic_power_law_gauss_realisation(-1., 1. / u.Mpc, 1.)
+    npt.assert_allclose(FourierEstimator3D(test_gaussian_realisation).get_power_3D(norm=False)[0], power_evaluated, atol=1.e-12)
+    npt.assert_array_equal(test_gaussian_realisation_paired, -1. * test_gaussian_realisation)
+
 def test_isotropic_pre_computed_gauss_realisation():
     fname = os.path.dirname(os.path.abspath(__file__)) + '/P_k_z_4_default_CLASS.dat'
     test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
@@ -36,6 +97,47 @@ def test_anisotropic_pre_computed_gauss_realisation_mean():
     test_anisotropic_gaussian_realisation = test_gaussian_box.anisotropic_pre_computed_gauss_realisation(fname,anisotropic_function,n_interpolation_samples=250)
     assert np.absolute(np.mean(test_anisotropic_gaussian_realisation)) < 1.e-16
 
+def test_coordinate_grid_cache():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 10, 'y': 12, 'z': 8}, 4., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    k_samples_velocity = test_gaussian_box.k_box()
+    assert test_gaussian_box.k_box() is k_samples_velocity
+    test_gaussian_box.convert_fourier_units_to_distance = True
+    k_samples_distance = test_gaussian_box.k_box()
+    assert k_samples_distance.unit == (1. / u.Mpc)
+    npt.assert_array_equal(k_samples_distance, test_gaussian_box._build_k_box())
+    test_gaussian_box.coordinate_grid_cache_dir = tempfile.mkdtemp()
+    test_gaussian_box.clear_coordinate_grid_cache()
+    test_gaussian_box.mu_box()
+    test_gaussian_box.clear_coordinate_grid_cache()
+    npt.assert_array_equal(test_gaussian_box.mu_box(), test_gaussian_box._build_mu_box())
+
+def test_open_grid_gauss_realisation():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 14, 'y': 12, 'z': 10}, 4., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    anisotropic_function = lambda a, b: np.array([a.value ** 2, 0. * a.value, 1. + 0. * a.value])
+    npr.seed(0)
+    test_gaussian_realisation = test_gaussian_box.anisotropic_power_law_gauss_realisation(-1., 1. / u.Mpc, 1., anisotropic_function)
+    test_gaussian_box.use_open_grid = True
+    npr.seed(0)
+    test_open_grid_realisation = test_gaussian_box.anisotropic_power_law_gauss_realisation(-1., 1. / u.Mpc, 1., anisotropic_function)
+    npt.assert_allclose(test_open_grid_realisation, test_gaussian_realisation)
+
+def test_unit_free_coordinate_grids():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 10, 'y': 12, 'z': 8}, 4., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    k_samples = test_gaussian_box.k_box()
+    test_gaussian_box.use_units = False
+    assert not is_astropy_quantity(test_gaussian_box.k_box())
+    npt.assert_allclose(test_gaussian_box.k_box(), k_samples.to_value(test_gaussian_box.fourier_space_units()))
+
+def test_k_shells():
+    for test_box_size in [{'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}, {'x': 25. * u.Mpc, 'y': 30. * u.Mpc, 'z': 20. * u.Mpc}]:
+        test_gaussian_box = GaussianBox(test_box_size, {'x': 10, 'y': 12, 'z': 8}, 4., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+        k_shell_values, k_shell_index = test_gaussian_box.k_shells()
+        assert k_shell_values.size == np.unique(test_gaussian_box.k_box().value.round(decimals=10)).size
+        npt.assert_allclose(k_shell_values[k_shell_index], test_gaussian_box.k_box())
+
 def test_choose_location_voigt_profiles_in_sky():
     test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
     test_gaussian_box = GaussianBox(test_box_size,{'x': 250, 'y': 250, 'z': 117},4.,(67.11*u.km)/(u.s*u.Mpc),0.3161)
@@ -52,6 +154,94 @@ def test_form_voigt_profile_box():
     test_zeros = np.zeros((test_gaussian_box.num_clean_skewers,117))
     npt.assert_array_equal(test_gaussian_box._form_voigt_profile_box(1.*(u.km/u.s),1.*(u.km/u.s),1.,wrap_around=10)[0][no_voigt_profile_bool_arr],test_zeros)
 
+def test_evaluate_voigt_profiles_scatter():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 10, 'y': 10, 'z': 16}, 4., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    test_gaussian_box._num_voigt = 500
+    test_gaussian_box._choose_location_voigt_profiles_in_sky()
+    z_values = np.arange(-32, 48) * test_gaussian_box.voxel_velocities['z']
+    z0_values = npr.choice(16, 500, replace=True) * test_gaussian_box.voxel_velocities['z']
+    voigt_profile_box, voigt_unwrapped = test_gaussian_box._evaluate_voigt_profiles(z_values, z0_values, 20. * (u.km / u.s), 10. * (u.km / u.s), 0.5, 2, return_unwrapped=True, chunk_size=64)
+    voigt_expected = np.zeros_like(voigt_profile_box)
+    for i, j in enumerate(test_gaussian_box._voigt_profile_skewers_index_arr):
+        voigt_expected[j] += np.sum(voigt_unwrapped[i].reshape(5, 16), axis=0)
+    npt.assert_allclose(voigt_profile_box, voigt_expected)
+    npt.assert_allclose(voigt_unwrapped, voigt_amplified(z_values[np.newaxis, :], 20. * (u.km / u.s), 10. * (u.km / u.s), 0.5, z0_values[:, np.newaxis]))
+
+def test_evaluate_voigt_profiles_fourier():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 10, 'y': 10, 'z': 64}, 4., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    test_gaussian_box._num_voigt = 500
+    test_gaussian_box._choose_location_voigt_profiles_in_sky()
+    z_values = np.arange(-640, 704) * test_gaussian_box.voxel_velocities['z']
+    z0_values = npr.choice(64, 500, replace=True) * test_gaussian_box.voxel_velocities['z']
+    sigma, gamma = 100. * (u.km / u.s), 20. * (u.km / u.s)
+    voigt_profile_box = test_gaussian_box._evaluate_voigt_profiles(z_values, z0_values, sigma, gamma, 0.5, 10)[0]
+    voigt_profile_box_fourier = test_gaussian_box._evaluate_voigt_profiles_fourier(z0_values, sigma, gamma, 0.5)[0]
+    npt.assert_allclose(voigt_profile_box_fourier, voigt_profile_box, rtol=1.e-3, atol=1.e-3 * np.max(voigt_profile_box))
+
+def test_voigt_template_cache():
+    dv = 10. * (u.km / u.s)
+    x = np.arange(-50, 51) * dv
+    sigma, gamma = 25. * (u.km / u.s), 8. * (u.km / u.s)
+    clear_voigt_template_cache()
+    cache_dir = tempfile.mkdtemp()
+    npt.assert_allclose(voigt_amplified_from_template(x, sigma, gamma, 0.5, 3. * dv, dv, cache_dir=cache_dir), voigt_amplified(x, sigma, gamma, 0.5, 3. * dv))
+    assert len(os.listdir(cache_dir)) == 1
+    clear_voigt_template_cache()
+    npt.assert_allclose(voigt_from_template(x, sigma, gamma, 0. * dv, dv, cache_dir=cache_dir), voigt(x, sigma, gamma, 0. * dv).value)
+
+def test_add_HCD_optical_depths():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 10, 'y': 10, 'z': 32}, 3., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    column_density_bin_edges = 10. ** np.linspace(17.2, 22., 25)
+    cddf = (column_density_bin_edges[:-1] / 1.e+17) ** -0.7
+    test_delta_flux = npr.normal(scale=0.1, size=(10, 10, 32))
+    contaminated_delta_flux, contaminated_mean_flux, column_densities = test_gaussian_box.add_HCD_optical_depths(test_delta_flux, 0.7, 50, cddf, column_density_bin_edges, chunk_size=7, rng=npr.default_rng(1))
+    assert np.all((column_densities.value >= column_density_bin_edges[0]) & (column_densities.value <= column_density_bin_edges[-1]))
+    assert contaminated_mean_flux < 0.7 * np.mean(1. + test_delta_flux)
+    npt.assert_allclose(np.mean(contaminated_delta_flux), 0., atol=1.e-12)
+    contaminated_skewers = test_gaussian_box._voigt_profile_skewers_bool_arr.reshape(10, 10)
+    flux_expected = 0.7 * (1. + test_delta_flux)
+    contaminated_flux = contaminated_mean_flux * (1. + contaminated_delta_flux)
+    npt.assert_allclose(contaminated_flux[~contaminated_skewers], flux_expected[~contaminated_skewers])
+    assert np.all(contaminated_flux[contaminated_skewers] <= flux_expected[contaminated_skewers] * (1. + 1.e-12))
+    assert np.all(np.min(contaminated_flux[contaminated_skewers] - flux_expected[contaminated_skewers], axis=-1) < 0.)
+    contaminated_mean_flux_2 = test_gaussian_box.add_HCD_optical_depths(test_delta_flux, 0.8, 50, cddf, column_density_bin_edges, chunk_size=7, rng=npr.default_rng(1))[1]
+    npt.assert_allclose(contaminated_mean_flux_2, contaminated_mean_flux * 0.8 / 0.7)
+
+def test_add_HCD_optical_depths_saved_CDDF():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 10, 'y': 10, 'z': 32}, 3., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    histogram_bin_edges = np.arange(17., 22.05, 0.1) #As saved by plot_forest.plot_CDDF
+    cddf = np.histogram(npr.uniform(17., 22., 1000), bins=histogram_bin_edges)
+    fname = os.path.join(tempfile.mkdtemp(), 'CDDF.npz')
+    np.savez(fname, np.array(cddf, dtype=object), histogram_bin_edges)
+    cddf_counts, log10_bin_edges = load_CDDF(fname)
+    npt.assert_array_equal(cddf_counts, cddf[0])
+    column_densities = test_gaussian_box.add_HCD_optical_depths(npr.normal(scale=0.1, size=(10, 10, 32)), 0.7, 50, cddf_counts, log10_bin_edges, rng=npr.default_rng(2), log10_edges=True)[2]
+    assert np.all((column_densities.value >= 1.e+17) & (column_densities.value <= 10. ** histogram_bin_edges[-1]))
+    npt.assert_allclose(sample_column_densities(50, cddf_counts, log10_bin_edges, rng=npr.default_rng(2), log10_edges=True).value, sample_column_densities(50, cddf_counts, 10. ** log10_bin_edges, rng=npr.default_rng(2)).value)
+
+def test_voigt_power_spectra():
+    column_densities = (10. ** np.linspace(17.5, 21., 8)) / (u.cm ** 2)
+    power_spectra, k_samples, delta_flux_FT = voigt_power_spectra(5000. * (u.km / u.s), 10. * (u.km / u.s), 0.7, column_densities, batch_size=3)
+    for i in range(column_densities.shape[0]):
+        power_expected, k_expected = voigt_power_spectrum(5000. * (u.km / u.s), 10. * (u.km / u.s), 0.7, column_density=column_densities[i])[:2]
+        npt.assert_allclose(power_spectra[i], power_expected)
+    npt.assert_allclose(k_samples, k_expected)
+
+def test_F_Voigt_template_bank():
+    column_densities = (10. ** np.linspace(17.5, 21., 20)) / (u.cm ** 2)
+    cddf_weights = column_densities.value ** -1.5
+    fname = os.path.join(tempfile.mkdtemp(), 'F_Voigt.npz')
+    save_F_Voigt_template_bank(fname, 5000. * (u.km / u.s), [10. * (u.km / u.s), 20. * (u.km / u.s)], [0.7, 0.8], [2.4, 3.], [(1.e+17, 1.e+19), (1.e+19, 1.e+22)], column_densities, cddf_weights)
+    in_range = column_densities.value >= 1.e+19
+    k_expected, F_Voigt_expected = voigt_F_HCD(5000. * (u.km / u.s), 20. * (u.km / u.s), 0.8, column_densities[in_range], cddf_weights[in_range])
+    k_samples, F_Voigt = load_F_Voigt_template(fname, 1, 1, 1)
+    npt.assert_allclose(k_samples, k_expected.value)
+    npt.assert_allclose(F_Voigt, F_Voigt_expected)
+
 def test_add_voigt_profiles():
     test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
     test_gaussian_box_instance = GaussianBox(test_box_size, {'x': 25, 'y': 25, 'z': 11}, 4., (67.11 * u.km) / (u.s * u.Mpc),0.3161)
@@ -74,6 +264,108 @@ def test_cross_power_spectrum():
     total_power = test_estimator_1.get_power_3D(norm=False)[0] + test_estimator_2.get_power_3D(norm=False)[0] + (2. * test_estimator_cross.get_power_3D(norm=False)[0])
     npt.assert_allclose(total_power, test_estimator_total.get_power_3D(norm = False)[0])
 
+def test_power_3D_single_precision():
+    test_box = npr.rand(30, 32, 28)
+    n_bins_x_y = (6, 3)
+    test_x_y = npr.rand(2, test_box.size - 1)
+    test_estimator = FourierEstimator3D(test_box)
+    test_estimator_single = FourierEstimator3D(test_box, precision='single')
+    assert test_estimator_single.get_power_3D()[0].dtype == np.float32
+    power_binned = test_estimator._form_return_list(test_x_y[0], test_x_y[1], n_bins_x_y[0], n_bins_x_y[1], True, False, False, False, False)[0]
+    power_binned_single = test_estimator_single._form_return_list(test_x_y[0], test_x_y[1], n_bins_x_y[0], n_bins_x_y[1], True, False, False, False, False)[0]
+    npt.assert_allclose(power_binned_single, power_binned, rtol=1.e-5)
+
+def test_bin_f_x_y_histogram_statistics():
+    test_x_y_f = npr.rand(3, 5000)
+    test_x_y_f[0, :10] = np.max(test_x_y_f[0])
+    power_binned, counts, std_err, x_binned, y_binned = bin_f_x_y_histogram_statistics(test_x_y_f[0], test_x_y_f[1], test_x_y_f[2], 7, 5)
+    for statistic, expected_statistic in zip([power_binned, counts, std_err], ['mean', 'count', standard_error]):
+        npt.assert_allclose(statistic, spt.binned_statistic_2d(test_x_y_f[0], test_x_y_f[1], test_x_y_f[2], statistic=expected_statistic, bins=[7, 5])[0])
+    npt.assert_allclose(x_binned, spt.binned_statistic_2d(test_x_y_f[0], test_x_y_f[1], test_x_y_f[0], bins=[7, 5])[0])
+    npt.assert_allclose(y_binned, spt.binned_statistic_2d(test_x_y_f[0], test_x_y_f[1], test_x_y_f[1], bins=[7, 5])[0])
+
+def test_power_3D_real_fft():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 14, 'y': 12, 'z': 11}, 4., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    k_box, mu_box = test_gaussian_box.k_box(), np.absolute(test_gaussian_box.mu_box())
+    test_estimator = FourierEstimator3D(npr.rand(14, 12, 11))
+    power_binned = test_estimator.get_power_3D_two_coords_binned(k_box, mu_box, 6, 3, count=True, std_err=True)
+    power_multipole = test_estimator.get_flux_power_3D_multipole(2, k_box, mu_box, 6)[0]
+    test_estimator.use_real_fft = True
+    assert test_estimator.get_power_3D()[0].shape == (14, 12, 6)
+    for power_binned_real_fft, power_binned_expected in zip(test_estimator.get_power_3D_two_coords_binned(k_box, mu_box, 6, 3, count=True, std_err=True), power_binned):
+        npt.assert_allclose(get_value(power_binned_real_fft), get_value(power_binned_expected))
+    npt.assert_allclose(test_estimator.get_flux_power_3D_multipole(2, k_box, mu_box, 6)[0], power_multipole)
+
+def test_power_3D_binning_plan():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 14, 'y': 12, 'z': 10}, 4., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    test_gaussian_box.convert_fourier_units_to_distance = True
+    k_bin_edges = np.linspace(0.2, 3., 7) / u.Mpc
+    mu_bin_edges = np.linspace(0., 1., 4)
+    test_estimator = FourierEstimator3D(npr.rand(14, 12, 10))
+    power_binned = test_estimator.get_power_3D_two_coords_binned(test_gaussian_box.k_box(), np.absolute(test_gaussian_box.mu_box()), k_bin_edges, mu_bin_edges, count=True, std_err=True)
+    fname = os.path.join(tempfile.mkdtemp(), 'binning_plan.npz')
+    BinningPlan(test_gaussian_box, k_bin_edges, mu_bin_edges).save(fname)
+    for power_binned_plan, power_binned_expected in zip(test_estimator.get_power_3D_plan_binned(load_binning_plan(fname), count=True, std_err=True), power_binned):
+        npt.assert_allclose(power_binned_plan, get_value(power_binned_expected))
+    test_gaussian_box.use_units = False
+    binning_plan_unit_free = BinningPlan(test_gaussian_box, k_bin_edges.to(1. / u.kpc), mu_bin_edges)
+    assert binning_plan_unit_free.k_unit == 1. / u.Mpc
+    for power_binned_plan, power_binned_expected in zip(test_estimator.get_power_3D_plan_binned(binning_plan_unit_free, count=True, std_err=True), power_binned):
+        npt.assert_allclose(power_binned_plan, get_value(power_binned_expected))
+
+def test_multi_field_power_3D():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 14, 'y': 12, 'z': 10}, 4., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    test_fields = {'forest': npr.rand(14, 12, 10), 'HCD': npr.rand(14, 12, 10), 'dodged': npr.rand(14, 12, 10)}
+    binning_plan = BinningPlan(test_gaussian_box, 5, 3)
+    test_estimator = FourierEstimatorMultiField(test_fields, max_cached_fields=2)
+    power_binned, power_ratios = test_estimator.get_all_power_3D_plan_binned(binning_plan)
+    assert len(power_binned) == 6
+    power_binned_expected = FourierEstimator3D(test_fields['forest'], second_box=test_fields['HCD']).get_power_3D_plan_binned(binning_plan)[0]
+    npt.assert_allclose(power_binned[('forest', 'HCD')], power_binned_expected)
+    npt.assert_allclose(power_ratios[(('forest', 'HCD'), 'dodged')], power_binned_expected / power_binned[('dodged', 'dodged')])
+
+def test_power_3D_unique():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 14, 'y': 12, 'z': 10}, 4., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    k_box = test_gaussian_box.k_box()
+    test_estimator = FourierEstimator3D(npr.rand(14, 12, 10))
+    power = test_estimator.get_power_3D()[0]
+    power_unique, k_unique, counts, std_err = test_estimator.get_power_3D_unique(k_box, count=True, std_err=True)
+    npt.assert_allclose(power_unique, [np.mean(power[k_box == k]) for k in k_unique])
+    npt.assert_array_equal(counts, [np.sum(k_box == k) for k in k_unique])
+    power_shells, k_shells, counts_shells = test_estimator.get_power_3D_unique(k_box, count=True, k_shells=test_gaussian_box.k_shells())
+    assert np.sum(counts_shells) == k_box.size
+    npt.assert_allclose(np.sum(power_shells * counts_shells), np.sum(power))
+
+def test_power_3D_multipoles_binning_plan():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 14, 'y': 12, 'z': 10}, 4., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    k_box, mu_box = test_gaussian_box.k_box().value, np.absolute(test_gaussian_box.mu_box())
+    binning_plan = BinningPlan(test_gaussian_box, 5, 4)
+    test_estimator = FourierEstimator3D(npr.rand(14, 12, 10))
+    power = test_estimator.get_power_3D()[0]
+    power_multipoles, k_binned, counts = test_estimator.get_power_3D_multipoles_plan_binned(binning_plan, mu_box, count=True)
+    k_bin_index = np.minimum(np.searchsorted(binning_plan.k_bin_edges, k_box, side='right') - 1, 4).flatten()[1:]
+    for i, multipole in enumerate([0, 2, 4]):
+        power_legendre_weighted = (power * evaluate_legendre_polynomial(mu_box, multipole) * ((2. * multipole) + 1.)).flatten()[1:]
+        npt.assert_allclose(power_multipoles[i], [np.mean(power_legendre_weighted[k_bin_index == j]) for j in range(5)])
+    npt.assert_array_equal(counts, np.bincount(k_bin_index))
+
+def test_power_3D_two_coords_binned_open_grid():
+    test_box_size = {'x': 25. * u.Mpc, 'y': 25. * u.Mpc, 'z': 25. * u.Mpc}
+    test_gaussian_box = GaussianBox(test_box_size, {'x': 14, 'y': 12, 'z': 10}, 4., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    test_gaussian_box.convert_fourier_units_to_distance = True
+    test_estimator = FourierEstimator3D(npr.rand(14, 12, 10))
+    k_bin_edges = np.linspace(0.2, 3.5, 6) / u.Mpc
+    mu_bin_edges = np.linspace(0., 1., 4)
+    binned_full = test_estimator.get_power_3D_two_coords_binned(test_gaussian_box.k_box(), np.absolute(test_gaussian_box.mu_box()), k_bin_edges, mu_bin_edges, count=True, std_err=True)
+    binned_open_grid = test_estimator.get_power_3D_two_coords_binned_open_grid(test_gaussian_box.k_open_grid(), k_bin_edges, mu_bin_edges, count=True, std_err=True)
+    for i in range(len(binned_full)):
+        npt.assert_allclose(binned_open_grid[i], binned_full[i])
+
 def test_form_return_list():
     test_size = 10000
     n_bins_x_y = (10, 20)
@@ -112,6 +404,92 @@ def test_make_box_hermitian():
     real_box = np.fft.ifftn(hermitian_box,s=(10, 11, 12),axes=(0, 1, 2))
     npt.assert_allclose(real_box.imag, np.zeros_like(real_box.imag), atol=1.e-16)
 
+def test_make_plane_hermitian():
+    test_plane = npr.rand(10, 11) + npr.rand(10, 11) * 1.j
+    hermitian_plane = make_plane_hermitian(test_plane)
+    npt.assert_allclose(np.fft.ifft2(hermitian_plane).imag, np.zeros((10, 11)), atol=1.e-16)
+
 def test_gen_log_space():
     array_length = 100000
-    npt.assert_array_equal(gen_log_space(array_length, array_length), np.arange(array_length))
\ No newline at end of file
+    npt.assert_array_equal(gen_log_space(array_length, array_length), np.arange(array_length))
+
+def test_skewer_subsampling_without_copies():
+    test_box = npr.rand(14, 12, 10)
+    test_estimator = FourierEstimator3D(test_box, x_step=2, y_step=3)
+    assert np.shares_memory(test_estimator.skewers_3D(), test_box)
+    npt.assert_allclose(test_estimator.get_power_3D(norm=False)[0], np.absolute(np.fft.fftn(test_box[::2, ::3, :])) ** 2)
+    second_box = npr.rand(14, 12, 10)
+    test_estimator = FourierEstimator3D(test_box, second_box=second_box, grid=False, n_skewers=50)
+    skewer_mask = test_estimator.skewer_mask()
+    assert np.sum(skewer_mask) == 50
+    assert test_estimator.skewer_mask() is skewer_mask
+    masked_modes = [np.fft.fftn(np.where(skewer_mask[:, :, None], box, 0.)) / box.size for box in (test_box, second_box)]
+    power, fourier_modes = test_estimator.get_power_3D()
+    npt.assert_allclose(fourier_modes, masked_modes[0], atol=1.e-15)
+    npt.assert_allclose(power, np.real(masked_modes[0] * np.conj(masked_modes[1])), atol=1.e-15)
+    test_estimator.use_real_fft = True
+    npt.assert_allclose(test_estimator.get_power_3D_full_spectrum(), power, atol=1.e-15)
+
+def test_sampling_window_convolution():
+    test_power = npr.rand(12, 10, 8)
+    test_estimator = FourierEstimator3D(npr.rand(12, 10, 8), grid=False, n_skewers=40)
+    window = test_estimator.sampling_window()
+    npt.assert_allclose(np.sum(window), 40. / 120.)
+    windowed_power_expected = np.zeros_like(test_power)
+    for i in range(12):
+        for j in range(10):
+            windowed_power_expected += window[i, j] * np.roll(test_power, (i, j), axis=(0, 1))
+    npt.assert_allclose(test_estimator.convolve_with_sampling_window(test_power), windowed_power_expected)
+    test_estimator = FourierEstimator3D(npr.rand(12, 10, 8), x_step=3, y_step=2)
+    aliased_power_expected = np.sum(test_power.reshape(3, 4, 2, 5, 8), axis=(0, 2))
+    npt.assert_allclose(test_estimator.convolve_with_sampling_window(test_power), aliased_power_expected)
+    test_estimator.use_real_fft = True
+    npt.assert_allclose(test_estimator.convolve_with_sampling_window(test_power), aliased_power_expected[..., :5])
+    test_estimator = FourierEstimator3D(npr.rand(12, 10, 8), x_step=5)
+    npt.assert_raises(ValueError, test_estimator.convolve_with_sampling_window, test_power)
+
+def test_power_1D_streamed():
+    test_tau = npr.rand(250, 16)
+    test_box = SimulationBox.__new__(SimulationBox)
+    test_box.element, test_box.ion, test_box.line_wavelength, test_box.precision = 'H', 1, 1215 * u.angstrom, 'double'
+    with tempfile.TemporaryDirectory() as test_dir:
+        test_box.spectra_instance = type('TestSpectra', (), {'savefile': os.path.join(test_dir, 'test_spectra.hdf5')})
+        with h5py.File(test_box.spectra_instance.savefile, 'w') as hdf5_file:
+            hdf5_file.create_dataset('tau/H/1/1215', data=test_tau)
+        delta_flux = np.exp(-1. * test_tau) / np.mean(np.exp(-1. * test_tau)) - 1.
+        npt.assert_allclose(np.concatenate(list(test_box.delta_flux_skewer_chunks(chunk_size=64))), delta_flux)
+        average_power, power_variance, n_skewers, power_covariance = get_power_1D_streamed(test_box.delta_flux_skewer_chunks(chunk_size=64), covariance=True)
+        scaled_delta_flux = np.concatenate(list(test_box.delta_flux_skewer_chunks(chunk_size=64, mean_flux_desired=0.5)))
+        npt.assert_allclose(np.mean(scaled_delta_flux), 0., atol=1.e-10)
+        scale = test_box._get_scale(test_tau, 0.5)
+        npt.assert_allclose(scaled_delta_flux, np.exp(-1. * test_tau * scale) / np.mean(np.exp(-1. * test_tau * scale)) - 1., rtol=1.e-5)
+    power = np.absolute(np.fft.rfft(delta_flux, axis=-1) / 16.) ** 2
+    assert n_skewers == 250
+    npt.assert_allclose(average_power, np.mean(power, axis=0))
+    npt.assert_allclose(power_variance, np.var(power, axis=0, ddof=1))
+    npt.assert_allclose(power_covariance, np.cov(power, rowvar=False))
+    npt.assert_raises(ValueError, get_power_1D_streamed, iter([]))
+    npt.assert_raises(ValueError, get_power_1D_streamed, iter([delta_flux[:1]]))
+    test_estimator = FourierEstimator1D(delta_flux.reshape(10, 25, 16))
+    average_power, power_variance = test_estimator.get_power_1D_statistics(chunk_size=37)[:2]
+    npt.assert_allclose(average_power, test_estimator.get_power_1D())
+    npt.assert_allclose(power_variance, np.var(power, axis=0, ddof=1))
+
+def test_power_3D_sub_volume_covariance():
+    test_box_size = {'x': 12.5 * u.Mpc, 'y': 12.5 * u.Mpc, 'z': 25. * u.Mpc}
+    test_sub_volume_box = GaussianBox(test_box_size, {'x': 7, 'y': 6, 'z': 10}, 4., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    binning_plan = BinningPlan(test_sub_volume_box, 4, 3)
+    test_box = npr.rand(14, 12, 10)
+    test_estimator = FourierEstimator3D(test_box)
+    power_sub_volumes = np.array([FourierEstimator3D(test_box[i * 7: (i + 1) * 7, j * 6: (j + 1) * 6]).get_power_3D_plan_binned(binning_plan)[0].flatten()
+                                  for i in range(2) for j in range(2)])
+    power_mean, power_covariance = test_estimator.get_power_3D_sub_volume_covariance(binning_plan)
+    npt.assert_allclose(power_mean.flatten(), np.mean(power_sub_volumes, axis=0))
+    npt.assert_allclose(power_covariance, np.cov(power_sub_volumes, rowvar=False) / 4., atol=1.e-15)
+    power_mean_parallel, power_covariance_parallel = test_estimator.get_power_3D_sub_volume_covariance(binning_plan, n_processes=2)
+    npt.assert_allclose(power_mean_parallel, power_mean)
+    npt.assert_allclose(power_covariance_parallel, power_covariance, atol=1.e-15)
+    power_covariance_bootstrap = test_estimator.get_power_3D_sub_volume_covariance(binning_plan, resampling='bootstrap', seed=42)[1]
+    assert power_covariance_bootstrap.shape == (12, 12)
+    npt.assert_allclose(np.diag(power_covariance_bootstrap), np.diag(power_covariance) * 3. / 4., rtol=0.3)
+    npt.assert_raises(ValueError, test_estimator.get_power_3D_sub_volume_covariance, binning_plan, n_sub_volumes=(3, 2))
@@ -17,6 +17,11 @@ def test_isotropic_power_law_power_spectra():
     isotropic_power = isotropic_power_instance.evaluate3d_isotropic(test_k)
     npt.assert_array_equal(isotropic_power, np.ones_like(test_k.value))
 
+def test_power_law_power_spectra_unit_free():
+    test_k = np.arange(1.e-3, 1.e+2, 1.e-3) / u.Mpc
+    power_instance = PowerLawPowerSpectrum(-1., 0.5 / u.Mpc, 2.)
+    npt.assert_allclose(power_instance.evaluate3d_isotropic(test_k.value), power_instance.evaluate3d_isotropic(test_k).value)
+
 def test_pre_computed_power_spectra_no_interpolation_limit():
     fname = os.path.dirname(os.path.abspath(__file__)) + '/P_k_z_4_default_CLASS.dat'
     pre_computed_power_instance = PreComputedPowerSpectrum(fname,n_interpolation_samples = 'default')
@@ -28,4 +33,24 @@ def test_anisotropic_power_law_power_spectra_isotropic_limit():
     isotropic_power_instance = PowerLawPowerSpectrum(-1., 1. / u.Mpc, 1.)
     anisotropic_power_instance = PowerLawPowerSpectrum(-1., 1. / u.Mpc, 1.)
     anisotropic_power_instance.set_anisotropic_functional_form(lambda a, b:np.array([0., 0., 0., 0., 1.]))
-    npt.assert_allclose(anisotropic_power_instance.evaluate_multipole(0,test_k),isotropic_power_instance.evaluate3d_isotropic(test_k))
\ No newline at end of file
+    npt.assert_allclose(anisotropic_power_instance.evaluate_multipole(0,test_k),isotropic_power_instance.evaluate3d_isotropic(test_k))
+
+def test_anisotropic_power_spectra_cylindrical_table():
+    test_box = GaussianBox({'x': 25. * u.Mpc, 'y': 30. * u.Mpc, 'z': 20. * u.Mpc}, {'x': 12, 'y': 10, 'z': 8}, 3., (67.11 * u.km) / (u.s * u.Mpc), 0.3161)
+    test_box.convert_fourier_units_to_distance = True
+    mu_coefficients = lambda k_para, k_perp: np.array([np.sinc(k_para.value) * k_perp.value, 0. * k_para.value, np.cos(k_para.value), 0.1 * k_para.value, 1. + (0. * k_perp.value)])
+    power_instance = PowerLawPowerSpectrum(-1., 1. / u.Mpc, 1.)
+    power_instance.set_anisotropic_functional_form(mu_coefficients)
+    k, mu = test_box.k_box(), test_box.mu_box()
+    k_para, k_perp = spherical_to_cylindrical_coordinates(k, mu)
+    power_expected = power_instance.evaluate3d_isotropic(k) * np.polyval(mu_coefficients(k_para, k_perp), mu)
+    npt.assert_allclose(power_instance.evaluate3d_anisotropic(k, mu), power_expected)
+    npt.assert_allclose(power_instance.evaluate3d_anisotropic(k, mu, k_cylinders=test_box.k_cylinders()), power_expected)
+
+def test_anisotropic_power_spectra_multipoles_off_grid():
+    test_k = np.logspace(-2., 1., 10) / u.Mpc
+    power_instance = PowerLawPowerSpectrum(-1., 1. / u.Mpc, 1.)
+    power_instance.set_anisotropic_functional_form(lambda k_para, k_perp: np.array([0. * k_para.value, 0. * k_para.value, 0.5 + (0. * k_perp.value), 0. * k_para.value, 1. + (0. * k_perp.value)]))
+    isotropic_power = power_instance.evaluate3d_isotropic(test_k)
+    npt.assert_allclose(power_instance.evaluate_multipole(0, test_k), isotropic_power * (1. + (0.5 / 3.)), rtol=1.e-6)
+    npt.assert_allclose(power_instance.evaluate_multipole(2, test_k), isotropic_power * 0.5 * (2. / 3.), rtol=1.e-5)